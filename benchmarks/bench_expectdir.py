@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Benchmark of the expectdir pipeline on synthetic trees.
+
+Each scenario generates an initial, an expected and a candidate tree, then times the phases run by ExpectDir :
+materialization of initial/, replacement of current_dir_replace_string, cmpdir (and, as references, cmpdir without thread pool and
+a recursive filecmp.dircmp), and formatDiff.
+
+Usage : python benchmarks/bench_expectdir.py [--scale 1.0] [--repeat 3] [--only many_small,...] [--output results.json]
+"""
+from __future__ import annotations
+import argparse
+import filecmp
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from io import StringIO
+from pathlib import Path
+
+from pytest_expectdir.plugin import cmpdir, findAndReplaceAllInDir, formatDiff, materializeTree
+
+ALIAS = b'{{current_directory}}'
+
+def _textFile(rng:random.Random, size:int, alias_every:int=0):
+  lines = []
+  total = 0
+  n = 0
+  while total < size :
+    if alias_every and n % alias_every == 0 :
+      line = b'path = ' + ALIAS + b'/out/%d\n' % n
+    else :
+      line = b'row,%d,%d,%s\n' % (n, rng.randrange(1000), b'x' * rng.randrange(40))
+    lines.append(line)
+    total += len(line)
+    n += 1
+  return b''.join(lines)
+
+def _binaryFile(rng:random.Random, size:int):
+  return bytes(rng.getrandbits(8) for _ in range(size))
+
+def _mutate(data:bytes, rng:random.Random):
+  """
+  Change a few lines (or bytes for binaries) of `data`
+  """
+  if b'\0' in data[:1024] :
+    data = bytearray(data)
+    for _ in range(4) :
+      data[rng.randrange(len(data))] ^= 0xff
+    return bytes(data)
+  lines = data.splitlines(keepends=True)
+  for _ in range(max(1, len(lines) // 100)) :
+    lines[rng.randrange(len(lines))] = b'changed line\n'
+  return b''.join(lines)
+
+def _flat(count:int, size:int):
+  return [ (f'd{i // 100:03d}/f{i:05d}.txt', size) for i in range(count) ]
+
+def _deep(depth:int, width:int, size:int):
+  res = []
+  for w in range(width) :
+    parts = [ f'branch{w}' ] + [ f'level{d}' for d in range(depth) ]
+    res.extend((f'{"/".join(parts[:d + 1])}/f.txt', size) for d in range(len(parts)))
+  return res
+
+def _scenarios(scale:float):
+  n = lambda x : max(1, int(x * scale))
+  return {
+    'many_small' : dict(files=_flat(n(5000), 200), different=0.0),
+    'many_small_different' : dict(files=_flat(n(5000), 200), different=0.5),
+    'few_huge' : dict(files=[ (f'huge{i}.csv', n(20 << 20)) for i in range(3) ], different=0.0),
+    'few_huge_different' : dict(files=[ (f'huge{i}.csv', n(5 << 20)) for i in range(3) ], different=1.0),
+    'deep' : dict(files=_deep(n(60), 20, 500), different=0.1),
+    'binary' : dict(files=[ (f'blob{i}.bin', n(2 << 20)) for i in range(8) ], binary=True, different=0.5),
+  }
+
+def generate(root:Path, files:list, different:float=0.0, binary:bool=False, seed:int=0):
+  """
+  Write root/initial, root/expected and root/output (what the tested code would produce) for a scenario
+  """
+  rng = random.Random(seed)
+  for rel, size in files :
+    data = _binaryFile(rng, size) if binary else _textFile(rng, size, alias_every=50)
+    output = _mutate(data, rng) if rng.random() < different else data
+    for name, content in (('initial', data), ('expected', data), ('output', output)) :
+      path = root / name / rel
+      path.parent.mkdir(parents=True, exist_ok=True)
+      path.write_bytes(content)
+
+def _timed(fn):
+  t = time.perf_counter()
+  res = fn()
+  return time.perf_counter() - t, res
+
+def _dircmp(candidate:Path, expected:Path):
+  filecmp.clear_cache()
+  stack = [ filecmp.dircmp(candidate, expected) ]
+  while stack :
+    d = stack.pop()
+    d.diff_files
+    stack.extend(d.subdirs.values())
+
+def runScenario(root:Path, repeat:int):
+  """
+  Time each phase `repeat` times on the generated trees, and keep the best time of each
+  """
+  files = sum(len(f) for _, _, f in os.walk(root / 'expected'))
+  size = sum(p.stat().st_size for p in (root / 'expected').rglob('*') if p.is_file())
+  phases = {}
+  errors = {}
+  def record(name, timed) :
+    """
+    Run the timed phase, and return its result, or None if it failed
+    """
+    try :
+      duration, res = timed()
+    except Exception as e :
+      # Keep benchmarking the other phases, a failing phase is a result too : it stays failed even if another repeat succeeds
+      errors.setdefault(name, f'{type(e).__name__}: {e}'[:200])
+      phases[name] = None
+      return None
+    if name not in errors :
+      phases[name] = min(phases.get(name, duration), duration)
+    return res
+  different_files = None
+  for r in range(repeat) :
+    candidate = root / f'candidate{r}'
+    for strategy in ('copy', 'auto') :
+      target = root / f'materialized_{strategy}{r}'
+      record(f'materialize_{strategy}', lambda : _timed(lambda : materializeTree(root / 'initial', target, strategy)))
+      # The failing materialization may not have created the target
+      shutil.rmtree(target, ignore_errors=True)
+    shutil.copytree(root / 'output', candidate)
+    path = str(candidate).encode('utf8')
+    record('replace', lambda : _timed(lambda : findAndReplaceAllInDir(candidate, ALIAS, path)))
+    record('replace_reverse', lambda : _timed(lambda : findAndReplaceAllInDir(candidate, path, ALIAS)))
+    compared = record('cmpdir', lambda : _timed(lambda : cmpdir(candidate, root / 'expected')))
+    # Without the thread pool, and the recursive dircmp it replaces, as references
+    record('cmpdir_sequential', lambda : _timed(lambda : cmpdir(candidate, root / 'expected', workers=1)))
+    record('dircmp', lambda : _timed(lambda : _dircmp(candidate, root / 'expected')))
+    if compared is not None :
+      diffRes = compared[1]
+      different_files = sum(len(l) for l in diffRes)
+      record('formatDiff', lambda : _timed(lambda : formatDiff(StringIO(), candidate, root / 'expected', diffRes, max_files=100, max_bytes=1 << 20, max_report=1000000)))
+    shutil.rmtree(candidate)
+  return {
+    'files' : files,
+    'bytes' : size,
+    'different_files' : different_files,
+    'phases' : phases,
+    'errors' : errors,
+  }
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--scale', type=float, default=1.0, help='Multiply the number and the size of the generated files')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each phase, the best time is kept')
+  parser.add_argument('--only', default=None, help='Comma separated list of scenarios to run')
+  parser.add_argument('--output', default=None, help='JSON file to write the results to (default: stdout)')
+  parser.add_argument('--tmp', default=None, help='Directory where the trees are generated')
+  args = parser.parse_args(argv)
+  
+  scenarios = _scenarios(args.scale)
+  if args.only :
+    scenarios = { k : scenarios[k] for k in args.only.split(',') }
+  results = {
+    'python' : sys.version.split()[0],
+    'platform' : platform.platform(),
+    'scale' : args.scale,
+    'repeat' : args.repeat,
+    'scenarios' : {},
+  }
+  for name, spec in scenarios.items() :
+    root = Path(tempfile.mkdtemp(prefix=f'expectdir-bench-{name}-', dir=args.tmp))
+    try :
+      generate(root, **spec)
+      results['scenarios'][name] = runScenario(root, args.repeat)
+    finally :
+      shutil.rmtree(root)
+    print(f'{name}: ' + ', '.join(
+      f'{k}={"error" if v is None else f"{v:.3f}s"}' for k, v in results['scenarios'][name]['phases'].items()
+    ), file=sys.stderr)
+  
+  out = json.dumps(results, indent=2)
+  if args.output :
+    with open(args.output, 'w') as f :
+      f.write(out + '\n')
+  else :
+    print(out)
+
+if __name__ == '__main__' :
+  main()
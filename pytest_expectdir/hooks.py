@@ -0,0 +1,17 @@
+"""
+Hook specifications of pytest-expectdir
+"""
+import pytest
+
+@pytest.hookspec
+def pytest_expectdir_phase(item, candidate, phase, duration, bytes, files):
+  """
+  Called after each phase of an expectdir `with` block.
+
+  :param item: the test item running the block
+  :param candidate: the path of the candidate directory
+  :param phase: one of materialize, replace, replace_reverse, compare, update or diff
+  :param duration: duration of the phase in seconds
+  :param bytes: number of bytes processed by the phase (for diff, the size of the report, for update, the bytes written)
+  :param files: number of files processed by the phase
+  """
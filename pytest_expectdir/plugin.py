@@ -1,16 +1,52 @@
 from __future__ import annotations
 import os
+import re
 import shutil
 import sys
-from pathlib import Path
-from filecmp import dircmp
-from contextlib import contextmanager
+import json
+import time
+import hashlib
+import threading
+import asyncio
+import tempfile
+import mmap
+import struct
+import tarfile
+import zipfile
+import zlib
+import codecs
+from itertools import zip_longest
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor, Executor
+from contextlib import contextmanager, asynccontextmanager
 from typing import TYPE_CHECKING
-from io import StringIO
+from io import StringIO, BytesIO, TextIOWrapper
 from difflib import SequenceMatcher
+from bisect import bisect_left
+from collections import OrderedDict
+from xml.etree import ElementTree
 
 import pytest
 
+try :
+  import fcntl
+except ImportError : # pragma: no cover
+  fcntl = None
+
+try :
+  import yaml
+except ImportError : # pragma: no cover
+  yaml = None
+
+try :
+  import tomllib
+except ImportError : # pragma: no cover
+  try :
+    import tomli as tomllib
+  except ImportError :
+    tomllib = None
+
 if TYPE_CHECKING : # pragma: no cover
   from typing import TextIO, Iterable
 
@@ -19,6 +55,8 @@ RED = '\x1b[31m'
 GREEN = '\x1b[32m'
 CYAN = '\x1b[36m'
 YELLOW = '\x1b[33m'
+REVERSE = '\x1b[7m'
+NO_REVERSE = '\x1b[27m'
 
 
 def _win32_longpath(path):
@@ -37,14 +75,195 @@ def _win32_longpath(path):
   else:
       return path
 
-def formatFileDiff(f:TextIO, lines_candidate:Iterable[str], lines_expected:Iterable[str], context=3, indent='  '):
+DIFF_ALGORITHMS = ('auto', 'difflib', 'patience')
+# Above this number of line pairs, difflib is too slow and patience diff is used instead
+_DIFFLIB_MAX_PRODUCT = 4000000
+
+class DiffTimeout(Exception):
+  pass
+
+def _longestIncreasing(pairs:list):
+  """
+  Longest subsequence of `pairs` (sorted by first item) whose second items are increasing
+  """
+  tails = [] # tails[k] : the smallest second item ending an increasing subsequence of length k + 1
+  tails_idx = []
+  prev = [None] * len(pairs)
+  for n, (_, j) in enumerate(pairs) :
+    k = bisect_left(tails, j)
+    if k == len(tails) :
+      tails.append(j)
+      tails_idx.append(n)
+    else :
+      tails[k] = j
+      tails_idx[k] = n
+    prev[n] = tails_idx[k - 1] if k else None
+  res = []
+  n = tails_idx[-1] if tails_idx else None
+  while n is not None :
+    res.append(pairs[n])
+    n = prev[n]
+  res.reverse()
+  return res
+
+def _patienceMatches(a:list, b:list, deadline:float|None=None):
+  """
+  Matching lines (i, j) of a and b, using unique lines as anchors (patience diff), and difflib on the small regions without unique lines.
+  """
+  matches = []
+  stack = [(0, len(a), 0, len(b))]
+  while stack :
+    if deadline is not None and time.monotonic() > deadline :
+      raise DiffTimeout()
+    alo, ahi, blo, bhi = stack.pop()
+    while alo < ahi and blo < bhi and a[alo] == b[blo] :
+      matches.append((alo, blo))
+      alo += 1
+      blo += 1
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1] :
+      ahi -= 1
+      bhi -= 1
+      matches.append((ahi, bhi))
+    if alo == ahi or blo == bhi :
+      continue
+    # Line -> its index if it is unique in the region, else -1
+    unique_a = {}
+    for i in range(alo, ahi) :
+      unique_a[a[i]] = -1 if a[i] in unique_a else i
+    unique_b = {}
+    for j in range(blo, bhi) :
+      unique_b[b[j]] = -1 if b[j] in unique_b else j
+    common = [
+      (i, unique_b[a[i]]) for i in range(alo, ahi)
+      if unique_a[a[i]] == i and unique_b.get(a[i], -1) >= 0
+    ]
+    if not common :
+      if (ahi - alo) * (bhi - blo) <= _DIFFLIB_MAX_PRODUCT :
+        matcher = SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+        for i, j, n in matcher.get_matching_blocks() :
+          matches.extend((alo + i + k, blo + j + k) for k in range(n))
+      # Else the whole region is reported as replaced
+      continue
+    prev_a, prev_b = alo, blo
+    for i, j in _longestIncreasing(common) :
+      matches.append((i, j))
+      stack.append((prev_a, i, prev_b, j))
+      prev_a, prev_b = i + 1, j + 1
+    stack.append((prev_a, ahi, prev_b, bhi))
+  matches.sort()
+  return matches
+
+def _opcodesFromMatches(matches:list, la:int, lb:int):
+  """
+  Same as SequenceMatcher.get_opcodes() from a sorted list of matching lines
+  """
+  blocks = []
+  for i, j in matches :
+    if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j :
+      blocks[-1][2] += 1
+    else :
+      blocks.append([i, j, 1])
+  blocks.append([la, lb, 0])
+  opcodes = []
+  i = j = 0
+  for ai, bj, size in blocks :
+    if i < ai and j < bj :
+      opcodes.append(('replace', i, ai, j, bj))
+    elif i < ai :
+      opcodes.append(('delete', i, ai, j, bj))
+    elif j < bj :
+      opcodes.append(('insert', i, ai, j, bj))
+    i, j = ai + size, bj + size
+    if size :
+      opcodes.append(('equal', ai, i, bj, j))
+  return opcodes
+
+def _coarseOpcodes(a:list, b:list):
+  """
+  Opcodes with only the common prefix and suffix, and the lines in between summarized as one 'coarse' hunk
+  """
+  la, lb = len(a), len(b)
+  prefix = 0
+  while prefix < la and prefix < lb and a[prefix] == b[prefix] :
+    prefix += 1
+  suffix = 0
+  while suffix < la - prefix and suffix < lb - prefix and a[la - 1 - suffix] == b[lb - 1 - suffix] :
+    suffix += 1
+  opcodes = []
+  if prefix :
+    opcodes.append(('equal', 0, prefix, 0, prefix))
+  opcodes.append(('coarse', prefix, la - suffix, prefix, lb - suffix))
+  if suffix :
+    opcodes.append(('equal', la - suffix, la, lb - suffix, lb))
+  return opcodes
+
+def diffOpcodes(a:list, b:list, algorithm:str='difflib', timeout:float|None=None):
+  """
+  Return the opcodes (like SequenceMatcher.get_opcodes()) to transform the lines `a` into `b`.
+  With 'auto', difflib is used for small inputs and patience diff for big ones.
+  If the patience diff takes more than `timeout` seconds, only a coarse hunk is returned.
+  """
+  if algorithm not in DIFF_ALGORITHMS :
+    raise ValueError(f'Unknown diff algorithm {algorithm!r}, expected one of {DIFF_ALGORITHMS}')
+  if algorithm == 'auto' :
+    algorithm = 'difflib' if len(a) * len(b) <= _DIFFLIB_MAX_PRODUCT else 'patience'
+  if algorithm == 'difflib' :
+    return SequenceMatcher(None, a, b).get_opcodes()
+  # Compare integers instead of lines
+  ids = {}
+  a_ids = [ ids.setdefault(l, len(ids)) for l in a ]
+  b_ids = [ ids.setdefault(l, len(ids)) for l in b ]
+  deadline = None if timeout is None else time.monotonic() + timeout
+  try :
+    return _opcodesFromMatches(_patienceMatches(a_ids, b_ids, deadline), len(a), len(b))
+  except DiffTimeout :
+    return _coarseOpcodes(a_ids, b_ids)
+
+def _highlightChanges(line_a:str, line_b:str):
+  """
+  Return both lines with the characters that differ highlighted, or None if they are too different for it to be useful
+  """
+  end_a = len(line_a.rstrip('\n'))
+  end_b = len(line_b.rstrip('\n'))
+  matcher = SequenceMatcher(None, line_a[:end_a], line_b[:end_b], autojunk=False)
+  if matcher.real_quick_ratio() < 0.5 or matcher.quick_ratio() < 0.5 or matcher.ratio() < 0.5 :
+    return None
+  res_a, res_b = [], []
+  for tag, alo, ahi, blo, bhi in matcher.get_opcodes() :
+    if tag == 'equal' :
+      res_a.append(line_a[alo:ahi])
+      res_b.append(line_b[blo:bhi])
+    else :
+      if ahi > alo :
+        res_a.append(f'{REVERSE}{line_a[alo:ahi]}{NO_REVERSE}')
+      if bhi > blo :
+        res_b.append(f'{REVERSE}{line_b[blo:bhi]}{NO_REVERSE}')
+  return ''.join(res_a) + line_a[end_a:], ''.join(res_b) + line_b[end_b:]
+
+def _highlightHunk(a:list, b:list, max_length:int, max_pairs:int):
+  """
+  Highlight the changes between the lines of a 'replace' hunk, paired in order.
+  Only the first `max_pairs` pairs are highlighted, and only if both lines are shorter than `max_length`.
+  """
+  a = list(a)
+  b = list(b)
+  for k in range(min(len(a), len(b), max_pairs)) :
+    if len(a[k]) > max_length or len(b[k]) > max_length :
+      continue
+    highlighted = _highlightChanges(a[k], b[k])
+    if highlighted is not None :
+      a[k], b[k] = highlighted
+  return a, b
+
+def formatFileDiff(f:TextIO, lines_candidate:Iterable[str], lines_expected:Iterable[str], context=3, indent='  ', algorithm='difflib', timeout=None, intraline=False, intraline_max_length=1000, intraline_max_pairs=50):
   b, a = lines_candidate, lines_expected
-  matcher = SequenceMatcher(None, a, b)
-  for tag, alo, ahi, blo, bhi in matcher.get_opcodes():
+  for tag, alo, ahi, blo, bhi in diffOpcodes(a, b, algorithm, timeout):
     if tag == 'replace':
-      #TODO Add caractere-wise diff
-      f.write(''.join(f'{RED}{indent}- {l}' for l in a[alo:ahi]))
-      f.write(''.join(f'{GREEN}{indent}+ {l}' for l in b[blo:bhi]))
+      removed, added = a[alo:ahi], b[blo:bhi]
+      if intraline :
+        removed, added = _highlightHunk(removed, added, intraline_max_length, intraline_max_pairs)
+      f.write(''.join(f'{RED}{indent}- {l}' for l in removed))
+      f.write(''.join(f'{GREEN}{indent}+ {l}' for l in added))
     elif tag == 'delete':
       f.write(''.join(f'{RED}{indent}- {l}' for l in a[alo:ahi]))
     elif tag == 'insert':
@@ -58,39 +277,865 @@ def formatFileDiff(f:TextIO, lines_candidate:Iterable[str], lines_expected:Itera
       else :
         f.write(RESET)
         f.write(''.join(f'{RESET}{indent}  {l}' for l in a[alo:ahi]))
+    elif tag == 'coarse':
+      f.write(f'{CYAN}{indent}[...] --- diff too long to compute : {RED}expected:{alo + 1}-{ahi}{CYAN} / {GREEN}candidate:{blo + 1}-{bhi}{CYAN} differ ---\n')
         
     else: # pragma: no cover
       raise ValueError('unknown tag %r' % (tag,))
 
-def formatDiff(f:TextIO, candidate:Path, expected:Path, diffRes):
+_BINARY_HEAD = 8192
+
+def _isBinaryData(head:bytes):
+  """
+  Whether the first bytes of a file look binary : containing NUL bytes, or not decodable as UTF-8
+  """
+  if b'\0' in head :
+    return True
+  try :
+    # Not final, so that a multibyte character cut by the end of the head is accepted
+    codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+  except UnicodeDecodeError :
+    return True
+  return False
+
+class _BinaryDetector(object):
+  """
+  Cache of the binary detection of the files, keyed by path, size and mtime
+  """
+  CACHE_SIZE = 4096
+  def __init__(self):
+    self.cache = OrderedDict()
+    self.lock = threading.Lock()
+
+  def __call__(self, path:Path):
+    st = os.stat(path)
+    key = (str(Path(path).absolute()), st.st_size, st.st_mtime_ns)
+    with self.lock :
+      if key in self.cache :
+        self.cache.move_to_end(key)
+        return self.cache[key]
+    with open(path, 'rb') as f :
+      res = _isBinaryData(f.read(_BINARY_HEAD))
+    with self.lock :
+      self.cache[key] = res
+      if len(self.cache) > self.CACHE_SIZE :
+        self.cache.popitem(last=False)
+    return res
+
+isBinaryFile = _BinaryDetector()
+
+def _hexdumpRow(offset:int, row:bytes):
+  hexa = ' '.join(f'{x:02x}' for x in row)
+  text = ''.join(chr(x) if 0x20 <= x < 0x7f else '.' for x in row)
+  return f'{offset:08x}  {hexa:<47}  |{text}|'
+
+def formatBinaryDiff(f:TextIO, candidate:Iterable[bytes], expected:Iterable[bytes], indent='  ', context=2, block_size=1 << 16):
+  """
+  Print the summary of the differences between two binary streams : their sizes, the offset of the first difference,
+  and a hexdump of `context` rows of 16 bytes around it. Both streams are read once, by blocks of `block_size` bytes.
+  """
+  KEEP = (context + 1) * 16
+  sides = ([0, b'', None], [0, b'', None]) # [size, bytes before the current block (at most KEEP), window]
+  first = start = end = None
+  for blocks in zip_longest(_iterBlocks(candidate, block_size), _iterBlocks(expected, block_size), fillvalue=b'') :
+    if first is None and blocks[0] != blocks[1] :
+      common = min(len(blocks[0]), len(blocks[1]))
+      i = next((i for i in range(common) if blocks[0][i] != blocks[1][i]), common)
+      first = sides[0][0] + i
+      start = max(0, (first // 16 - context) * 16)
+      end = (first // 16 + context + 1) * 16
+      for side in sides :
+        side[2] = (side[1], side[0] - len(side[1]))
+    for side, block in zip(sides, blocks) :
+      if first is None :
+        side[1] = (side[1] + block)[-KEEP:]
+      elif len(side[2][0]) < end - side[2][1] :
+        side[2] = (side[2][0] + block, side[2][1])
+      side[0] += len(block)
+  (c_size, _, c_window), (e_size, _, e_window) = sides
+  f.write(f'{CYAN}{indent}binary files : {RED}expected {e_size} bytes{CYAN} / {GREEN}candidate {c_size} bytes{CYAN} ({c_size - e_size:+d})\n')
+  if first is None :
+    f.write(f'{CYAN}{indent}same content\n')
+    return
+  f.write(f'{CYAN}{indent}first difference at offset {first} (0x{first:x})\n')
+  rows = { 'expected' : e_window, 'candidate' : c_window }
+  for offset in range(start, end, 16) :
+    for name, color, sign in (('expected', RED, '-'), ('candidate', GREEN, '+')) :
+      data, base = rows[name]
+      row = data[offset - base:offset - base + 16]
+      if row :
+        f.write(f'{color}{indent}{sign} {_hexdumpRow(offset, row)}\n')
+
+class _ReportFull(Exception):
+  pass
+
+class _LimitedWriter(object):
+  """
+  Forward the writes to `f` until `limit` characters are written, then raise _ReportFull
+  """
+  def __init__(self, f:TextIO, limit:int|None):
+    self.f = f
+    self.remaining = limit
+
+  def write(self, s:str):
+    if self.remaining is not None :
+      if len(s) > self.remaining :
+        self.f.write(s[:self.remaining])
+        self.remaining = 0
+        raise _ReportFull()
+      self.remaining -= len(s)
+    self.f.write(s)
+
+def _takeBytes(parts:Iterable[bytes], max_bytes:int|None):
+  """
+  Join `parts` up to `max_bytes`, and return (data, truncated)
+  """
+  res = []
+  size = 0
+  for part in parts :
+    if max_bytes is not None and size + len(part) > max_bytes :
+      res.append(part[:max_bytes - size])
+      return b''.join(res), True
+    res.append(part)
+    size += len(part)
+  return b''.join(res), False
+
+def _readLines(path:Path|TreeSnapshot, rel:Path, replace:StreamReplacement|None=None, max_bytes:int|None=None, normalize:LineNormalizer|None=None):
+  """
+  Read at most `max_bytes` of a file (with `replace` and `normalize` applied to it), the same way as open(path, 'r') would, and return (lines, truncated)
+  If `path` is a TreeSnapshot, its file `rel` is read.
+  """
+  if isinstance(path, TreeSnapshot) :
+    parts = (path.read(rel),)
+  elif replace is not None and replace.applies(rel) :
+    parts = replace.iterFile(path)
+  else :
+    parts = _iterFile(path)
+  if normalize is not None :
+    parts = normalize.iterFile(parts)
+  data, truncated = _takeBytes(parts, max_bytes)
+  # A truncated file may end in the middle of a multibyte character, and the binary detection only looks at the head of the files
+  with TextIOWrapper(BytesIO(data), errors='replace') as f :
+    return f.readlines(), truncated
+
+def _isBinaryPair(candidate:Path, tree:TreeSnapshot|None, expected:Path, p:Path):
+  return isBinaryFile(candidate / p) or _isBinaryExpected(tree or expected, p)
+
+def formatDiff(f:TextIO, candidate:Path, expected:Path|TreeSnapshot, diffRes, replace:StreamReplacement|None=None, max_files:int|None=None, max_bytes:int|None=None, max_report:int|None=None, algorithm:str='difflib', timeout:float|None=None, intraline:bool=False, comparators:dict|None=None, normalize:LineNormalizer|None=None):
+  """
+  Print the diff summary of the result of cmpdir().
+  The file diffs are rendered one after the other, only for the first `max_files` files, reading at most `max_bytes` of each file,
+  and the rendering stops once the report reaches `max_report` characters.
+  `algorithm`, `timeout` and `intraline` are passed to formatFileDiff().
+  The files matching `comparators` are shown as structural differences, and the binary files as a summary (see formatBinaryDiff()).
+  `expected` may be a TreeSnapshot (e.g. an ArchiveTree). The text files are diffed after being normalized by `normalize` if passed.
+  """
   left, right, diff = diffRes
-  left = [ f'{p}{"/" if (candidate / p).is_dir() else ""}' for p in left ]
-  right = [ f'{p}{"/" if (expected / p).is_dir() else ""}' for p in right ]
-  f.write(f'{CYAN}Directory {RED}{expected} (expected){CYAN} is different from {GREEN}{candidate} (candidate){CYAN}.\n')
-  if right :
-    f.write(f'{RED}Missing in candidate :\n')
-    f.write(''.join( f'{RED}{l}\n' for l in right ))
-  if left :
-    f.write(f'{GREEN}Extra in candidate :\n')
-    f.write(''.join( f'{GREEN}{l}\n' for l in left ))
-  if diff :
-    f.write(f'{CYAN}In both directories but different content:\n')
-    for p in diff :
-      f.write(f'\n{YELLOW}{p}:\n')
-      with open(candidate/p, 'r') as lines_candidate, open(expected/p, 'r') as lines_expected :
-        formatFileDiff(f, list(lines_candidate), list(lines_expected))
-
-def cmpdir(candidate:Path, expected:Path):
-  res = [], [], []
-  left, right, diff = res
-  def inner(dc:dircmp, prefix):
-    left.extend(prefix / fn for fn in dc.left_only)
-    right.extend(prefix / fn for fn in dc.right_only)
-    diff.extend(prefix / fn for fn in dc.diff_files)
-    for sub_name, sub_dc in dc.subdirs.items() :
-      inner(sub_dc, prefix / sub_name)
-  inner(dircmp(candidate, expected, ignore=['.gitkeep']), Path(''))
-  
+  comparators = resolveComparators(comparators)
+  tree = expected if isinstance(expected, TreeSnapshot) else None
+  if tree is not None :
+    expected = tree.root
+  out = _LimitedWriter(f, max_report)
+  shown = 0
+  try :
+    out.write(f'{CYAN}Directory {RED}{expected} (expected){CYAN} is different from {GREEN}{candidate} (candidate){CYAN}.\n')
+    if getattr(diffRes, 'truncated', False) :
+      out.write(f'{CYAN}The comparison stopped after {sum(len(l) for l in diffRes)} differences, there may be more.\n')
+    if right :
+      out.write(f'{RED}Missing in candidate :\n')
+      for p in right :
+        is_dir = tree.isDir(p) if tree is not None else (expected / p).is_dir()
+        out.write(f'{RED}{p}{"/" if is_dir else ""}\n')
+    if left :
+      out.write(f'{GREEN}Extra in candidate :\n')
+      for p in left :
+        out.write(f'{GREEN}{p}{"/" if (candidate / p).is_dir() else ""}\n')
+    if diff :
+      out.write(f'{CYAN}In both directories but different content:\n')
+      for p in diff :
+        if max_files is not None and shown >= max_files :
+          break
+        out.write(f'\n{YELLOW}{p}:\n')
+        comparator = _findComparator(p, comparators) if comparators else None
+        if comparator is not None :
+          formatStructuredDiff(out, comparator, candidate / p, tree if tree is not None else expected / p, p, replace)
+          shown += 1
+          continue
+        if _isBinaryPair(candidate, tree, expected, p) :
+          if replace is not None and replace.applies(p) :
+            candidate_parts = replace.iterFile(candidate / p)
+          else :
+            candidate_parts = _iterFile(candidate / p)
+          formatBinaryDiff(out, candidate_parts, (tree.read(p),) if tree is not None else _iterFile(expected / p))
+          shown += 1
+          continue
+        lines_candidate, truncated_candidate = _readLines(candidate / p, p, replace, max_bytes, normalize)
+        lines_expected, truncated_expected = _readLines(tree if tree is not None else expected / p, p, None, max_bytes, normalize)
+        if truncated_candidate or truncated_expected :
+          out.write(f'{CYAN}  (only the first {max_bytes} bytes are compared)\n')
+        formatFileDiff(out, lines_candidate, lines_expected, algorithm=algorithm, timeout=timeout, intraline=intraline)
+        shown += 1
+    if shown < len(diff) :
+      out.write(f'\n{CYAN}{len(diff) - shown} other files with different content are not shown :\n')
+      for p in diff[shown:] :
+        out.write(f'{YELLOW}{p}\n')
+  except _ReportFull :
+    f.write(f'\n{CYAN}[...] Report truncated to {max_report} characters')
+    if shown < len(diff) :
+      f.write(f', {len(diff) - shown} files with different content are not shown')
+    f.write('.\n')
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+GITKEEP = '.gitkeep'
+DEFAULT_IGNORE = (GITKEEP,)
+IGNORE_FILE = '.expectdirignore'
+
+@lru_cache(maxsize=None)
+def _compileIgnorePattern(pattern:str):
+  """
+  Compile a gitignore-style pattern into (regex matching the relative posix path, negated, directories only)
+  """
+  negate = pattern.startswith('!')
+  if negate :
+    pattern = pattern[1:]
+  elif pattern.startswith('\\') :
+    # \# and \! escape the first character
+    pattern = pattern[1:]
+  dir_only = pattern.endswith('/')
+  pattern = pattern.rstrip('/')
+  # Like in .gitignore, a pattern containing a slash is relative to the root, else it matches a name at any depth
+  anchored = '/' in pattern
+  pattern = pattern.lstrip('/')
+  regex = [] if anchored else ['(?:.*/)?']
+  i = 0
+  while i < len(pattern) :
+    if pattern.startswith('**/', i) :
+      regex.append('(?:.*/)?')
+      i += 3
+    elif pattern.startswith('**', i) :
+      regex.append('.*')
+      i += 2
+    elif pattern[i] == '*' :
+      regex.append('[^/]*')
+      i += 1
+    elif pattern[i] == '?' :
+      regex.append('[^/]')
+      i += 1
+    elif pattern[i] == '[' and ']' in pattern[i + 2:] :
+      j = pattern.index(']', i + 2)
+      content = pattern[i + 1:j]
+      if content.startswith('!') :
+        content = '^' + content[1:]
+      regex.append(f'[{content}]')
+      i = j + 1
+    else :
+      regex.append(re.escape(pattern[i]))
+      i += 1
+  return re.compile(''.join(regex)), negate, dir_only
+
+class IgnoreRules(object):
+  """
+  Gitignore-style patterns of the entries skipped by cmpdir(). The last matching pattern wins, and the ignored directories are not walked.
+  The patterns are compiled once per process.
+  """
+  def __init__(self, patterns:Iterable[str]=DEFAULT_IGNORE):
+    self.patterns = tuple(p.strip() for p in patterns if p.strip() and not p.strip().startswith('#'))
+    self.rules = [ _compileIgnorePattern(p) for p in self.patterns ]
+
+  def extend(self, patterns:Iterable[str]|None):
+    """
+    Return the rules with `patterns` added after these ones (so that they have the priority)
+    """
+    if not patterns :
+      return self
+    if isinstance(patterns, str) :
+      patterns = [patterns]
+    return IgnoreRules(self.patterns + tuple(patterns))
+
+  def ignored(self, rel:Path, is_dir:bool):
+    return self._ignoredPosix(rel.as_posix(), is_dir)
+
+  def _ignoredPosix(self, path:str, is_dir:bool):
+    # Without building a Path for each entry of the walked directories
+    res = False
+    for regex, negate, dir_only in self.rules :
+      if (is_dir or not dir_only) and regex.fullmatch(path) :
+        res = not negate
+    return res
+
+def _posixPrefix(prefix:Path):
+  """
+  `prefix` as a posix string to which the names of its entries can be appended
+  """
+  return '' if prefix == Path('') else prefix.as_posix() + '/'
+
+def _scanEntries(path:Path, ignore:IgnoreRules|None=None, prefix:Path=Path('')):
+  """
+  List a directory once, returning {name: (is_dir, size, mtime_ns)}, skipping the entries (whose path is `prefix / name`) matching `ignore`.
+  Symlinks are followed, like dircmp does.
+  """
+  res = {}
+  base = _posixPrefix(prefix)
+  with os.scandir(path) as it :
+    for entry in it :
+      try :
+        is_dir = entry.is_dir()
+      except OSError :
+        is_dir = False
+      if ignore is not None and ignore._ignoredPosix(base + entry.name, is_dir) :
+        continue
+      try :
+        if is_dir :
+          res[entry.name] = (True, 0, 0)
+        else :
+          st = entry.stat()
+          res[entry.name] = (False, st.st_size, st.st_mtime_ns)
+      except OSError : # Broken symlink, or entry removed while walking
+        res[entry.name] = (False, -1, 0)
+  return res
+
+def _filesEqual(candidate:Path, expected:Path, chunk_size:int=DEFAULT_CHUNK_SIZE):
+  """
+  Compare the content of two files of the same size, chunk by chunk, stopping at the first difference.
+  """
+  try :
+    # Unbuffered, since the chunks are read whole
+    with open(candidate, 'rb', buffering=0) as fc, open(expected, 'rb', buffering=0) as fe :
+      while True :
+        cc = fc.read(chunk_size)
+        ce = fe.read(chunk_size)
+        if cc != ce :
+          return False
+        if len(cc) < chunk_size :
+          # A short read of a regular file is its end, no need to read both files again to see it
+          return True
+  except OSError :
+    return False
+
+def _iterFile(path:Path, chunk_size:int=DEFAULT_CHUNK_SIZE):
+  with open(path, 'rb') as f :
+    while True :
+      chunk = f.read(chunk_size)
+      if not chunk :
+        return
+      yield chunk
+
+def _partsEqualFile(parts:Iterable[bytes], path:Path):
+  """
+  Compare a stream of bytes to the content of a file, stopping at the first difference
+  """
+  with open(path, 'rb') as f :
+    for part in parts :
+      if f.read(len(part)) != part :
+        return False
+    return not f.read(1)
+
+def _partsEqualBytes(parts:Iterable[bytes], data:bytes):
+  """
+  Compare a stream of bytes to `data`, stopping at the first difference
+  """
+  view = memoryview(data)
+  offset = 0
+  for part in parts :
+    if view[offset:offset + len(part)] != part :
+      return False
+    offset += len(part)
+  return offset == len(data)
+
+def _iterBlocks(parts:Iterable[bytes], block_size:int):
+  """
+  Re-chunk a stream of bytes into blocks of `block_size` bytes (the last one may be shorter)
+  """
+  pending = []
+  size = 0
+  for part in parts :
+    while part :
+      piece = part[:block_size - size]
+      part = part[len(piece):]
+      pending.append(piece)
+      size += len(piece)
+      if size == block_size :
+        yield b''.join(pending)
+        pending = []
+        size = 0
+  if pending :
+    yield b''.join(pending)
+
+def _blockDigest(block:bytes):
+  return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+class DigestIndex(object):
+  """
+  Digests of the blocks of the expected files, keyed by absolute path, and invalidated when their size or mtime changes.
+  The files modified less than 2 seconds before being hashed are hashed again at each use.
+  It is persisted as a JSON sidecar file so that expected trees are not read again at each session.
+  Since each block has its own digest, comparing a candidate file can stop at its first differing block.
+  Several processes (e.g. pytest-xdist workers) can share the same file : saving merges the entries of the file with the new ones, under a file lock.
+  """
+  VERSION = 2
+  TOUCH_DELAY = 24 * 3600
+  BLOCK_SIZE = 1 << 20
+  def __init__(self, path:Path|None=None, max_age:float=30 * 24 * 3600):
+    self.path = path
+    self.max_age = max_age
+    self.entries = {} # abspath -> [size, mtime_ns, block digests, last_used]
+    self.dirty = False
+    self.updated = set() # keys added or touched since the index was loaded
+    self.lock = threading.Lock()
+    self.load()
+
+  def _read(self):
+    try :
+      with open(self.path, 'r') as f :
+        data = json.load(f)
+    except (OSError, ValueError) :
+      return {}
+    if data.get('version') == self.VERSION and data.get('block_size') == self.BLOCK_SIZE :
+      return data.get('entries', {})
+    return {}
+
+  def load(self):
+    if self.path is None :
+      return
+    self.entries = self._read()
+
+  @contextmanager
+  def _fileLock(self):
+    """
+    Exclusive lock between the processes sharing the index file (a no-op where fcntl is not available)
+    """
+    if fcntl is None : # pragma: no cover
+      yield
+      return
+    with open(self.path.with_name(f'{self.path.name}.lock'), 'a') as f :
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      try :
+        yield
+      finally :
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+  def save(self):
+    if self.path is None or not self.dirty :
+      return
+    now = time.time()
+    with self._fileLock() :
+      # Merge the entries saved by the other processes since the index was loaded, ours winning for the ones we updated
+      entries = self._read()
+      with self.lock :
+        for k, v in self.entries.items() :
+          if k in self.updated or k not in entries :
+            entries[k] = v
+        self.updated.clear()
+        # Evict the entries that were not used for a long time
+        self.entries = { k : v for k, v in entries.items() if now - v[3] <= self.max_age }
+        data = { 'version' : self.VERSION, 'block_size' : self.BLOCK_SIZE, 'entries' : self.entries }
+        self.dirty = False
+      tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+      with open(tmp, 'w') as f :
+        json.dump(data, f)
+      os.replace(tmp, self.path)
+
+  def digest(self, path:Path):
+    """
+    Return the list of the digests of the blocks of `path`, reading it only if it is not in the index or if it changed.
+    """
+    key = str(Path(path).absolute())
+    st = os.stat(key)
+    now = time.time()
+    with self.lock :
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns :
+        if now - entry[3] > self.TOUCH_DELAY :
+          entry[3] = now
+          self.updated.add(key)
+          self.dirty = True
+        return entry[2]
+    digest = [ _blockDigest(block) for block in _iterBlocks(_iterFile(key), self.BLOCK_SIZE) ]
+    mtime_ns = st.st_mtime_ns
+    if mtime_ns >= time.time_ns() - 2 * 10**9 :
+      # Like _changedFiles(), a file modified too recently may be modified again without changing its mtime on the file systems with coarse timestamps :
+      # its entry is not trusted, so that it is hashed again until it is old enough
+      mtime_ns = None
+    with self.lock :
+      self.entries[key] = [st.st_size, mtime_ns, digest, now]
+      self.updated.add(key)
+      self.dirty = True
+    return digest
+
+  def matches(self, path:Path, parts:Iterable[bytes]):
+    """
+    Whether the stream of bytes `parts` has the same content as `path`, hashing it block by block, and stopping at the first differing block
+    """
+    expected = self.digest(path)
+    n = 0
+    for n, block in enumerate(_iterBlocks(parts, self.BLOCK_SIZE), 1) :
+      if n > len(expected) or _blockDigest(block) != expected[n - 1] :
+        return False
+    return n == len(expected)
+
+_MISSING = object()
+
+class Comparator(object):
+  """
+  Compare files by their parsed content instead of their bytes.
+  The parsed expected documents are cached (keyed by path, size and mtime) so that they are parsed once per session.
+  """
+  CACHE_SIZE = 1024
+  def __init__(self):
+    self.cache = OrderedDict()
+    self.lock = threading.Lock()
+
+  def parse(self, data:bytes): # pragma: no cover
+    """
+    Return the canonical form of the document, as comparable python objects (dict, list, str...)
+    """
+    raise NotImplementedError()
+
+  def load(self, path:Path, tree:TreeSnapshot|None=None):
+    """
+    parse() the content of a file, or of the file `path` of `tree` if passed, cached
+    """
+    if tree is not None :
+      # The trees do not change during the session
+      key = (str(tree.root.absolute()), str(path), None)
+    else :
+      st = os.stat(path)
+      key = (str(Path(path).absolute()), st.st_size, st.st_mtime_ns)
+    with self.lock :
+      if key in self.cache :
+        self.cache.move_to_end(key)
+        return self.cache[key]
+    if tree is not None :
+      doc = self.parse(bytes(tree.read(path)))
+    else :
+      with open(path, 'rb') as f :
+        doc = self.parse(f.read())
+    with self.lock :
+      self.cache[key] = doc
+      if len(self.cache) > self.CACHE_SIZE :
+        self.cache.popitem(last=False)
+    return doc
+
+class JsonComparator(Comparator):
+  def parse(self, data:bytes):
+    return json.loads(data)
+
+class YamlComparator(Comparator):
+  def parse(self, data:bytes):
+    if yaml is None : # pragma: no cover
+      raise RuntimeError('PyYAML is required to compare YAML files (pip install pytest-expectdir[yaml])')
+    return yaml.safe_load(data)
+
+class TomlComparator(Comparator):
+  def parse(self, data:bytes):
+    if tomllib is None : # pragma: no cover
+      raise RuntimeError('tomli is required to compare TOML files before python 3.11 (pip install pytest-expectdir[toml])')
+    return tomllib.loads(data.decode('utf8'))
+
+class XmlComparator(Comparator):
+  """
+  Compare the elements, their attributes and their text, ignoring the whitespaces around the text
+  """
+  def parse(self, data:bytes):
+    return self._element(ElementTree.fromstring(data))
+
+  def _element(self, el):
+    return {
+      'tag' : el.tag,
+      'attrib' : dict(el.attrib),
+      'text' : (el.text or '').strip(),
+      'children' : [ self._element(child) for child in el ],
+      'tail' : (el.tail or '').strip(),
+    }
+
+COMPARATORS = {
+  'json' : JsonComparator(),
+  'yaml' : YamlComparator(),
+  'toml' : TomlComparator(),
+  'xml' : XmlComparator(),
+}
+
+def resolveComparators(comparators:dict|Iterable|None):
+  """
+  Return a list of (glob, Comparator) from a {glob: Comparator or name in COMPARATORS} mapping
+  """
+  if not comparators :
+    return []
+  if isinstance(comparators, dict) :
+    comparators = comparators.items()
+  res = []
+  for glob, comparator in comparators :
+    if isinstance(comparator, str) :
+      try :
+        comparator = COMPARATORS[comparator]
+      except KeyError :
+        raise ValueError(f'Unknown comparator {comparator!r}, expected one of {tuple(COMPARATORS)}') from None
+    res.append((glob, comparator))
+  return res
+
+def _findComparator(rel:Path, comparators:list):
+  posix = PurePosixPath(Path(rel).as_posix())
+  for glob, comparator in comparators :
+    if posix.match(glob) :
+      return comparator
+  return None
+
+def _readCandidate(path:Path, rel:Path, replace:StreamReplacement|None):
+  if replace is not None and replace.applies(rel) :
+    return replace.read(path)
+  with open(path, 'rb') as f :
+    return f.read()
+
+def _loadExpected(comparator:Comparator, expected:Path|TreeSnapshot, rel:Path):
+  if isinstance(expected, TreeSnapshot) :
+    return comparator.load(rel, expected)
+  return comparator.load(expected)
+
+def _structuredEqual(comparator:Comparator, candidate:Path, expected:Path|TreeSnapshot, rel:Path, replace:StreamReplacement|None):
+  try :
+    candidate_doc = comparator.parse(_readCandidate(candidate, rel, replace))
+    expected_doc = _loadExpected(comparator, expected, rel)
+    # Not ==, that would tell `true` and `1` are equal : the verdict must agree with formatStructuredDiff()
+    return next(_structuredDiff(expected_doc, candidate_doc), None) is None
+  except Exception :
+    # Unparsable files are reported as different, formatDiff() shows the error
+    return False
+
+def _structuredDiff(expected, candidate, path:str='$'):
+  """
+  Yield (path, expected, candidate) for each difference between two documents, with _MISSING for missing values
+  """
+  if isinstance(expected, dict) and isinstance(candidate, dict) :
+    for k in expected :
+      sub = f'{path}.{k}'
+      if k in candidate :
+        yield from _structuredDiff(expected[k], candidate[k], sub)
+      else :
+        yield sub, expected[k], _MISSING
+    for k in candidate :
+      if k not in expected :
+        yield f'{path}.{k}', _MISSING, candidate[k]
+  elif isinstance(expected, list) and isinstance(candidate, list) :
+    for i in range(max(len(expected), len(candidate))) :
+      yield from _structuredDiff(
+        expected[i] if i < len(expected) else _MISSING,
+        candidate[i] if i < len(candidate) else _MISSING,
+        f'{path}[{i}]',
+      )
+  elif expected is _MISSING or candidate is _MISSING :
+    yield path, expected, candidate
+  elif expected != candidate or type(expected) is not type(candidate) :
+    yield path, expected, candidate
+
+def _shortRepr(value, max_length:int=200):
+  res = json.dumps(value, sort_keys=True, default=str)
+  if len(res) > max_length :
+    res = res[:max_length] + '...'
+  return res
+
+def formatStructuredDiff(f:TextIO, comparator:Comparator, candidate:Path, expected:Path|TreeSnapshot, rel:Path, replace:StreamReplacement|None=None, indent='  '):
+  """
+  Print the differences between two structured documents, as the paths of the values that differ.
+  `expected` is the path of the expected file, or the TreeSnapshot containing it as `rel`.
+  """
+  docs = []
+  for name, load in (
+    ('expected', lambda : _loadExpected(comparator, expected, rel)),
+    ('candidate', lambda : comparator.parse(_readCandidate(candidate, rel, replace))),
+  ) :
+    try :
+      docs.append(load())
+    except Exception as e :
+      f.write(f'{RED if name == "expected" else GREEN}{indent}{name} cannot be parsed : {e}\n')
+      return
+  for path, e, c in _structuredDiff(*docs) :
+    if e is not _MISSING :
+      f.write(f'{RED}{indent}- {path}: {_shortRepr(e)}\n')
+    if c is not _MISSING :
+      f.write(f'{GREEN}{indent}+ {path}: {_shortRepr(c)}\n')
+
+class _StopWalk(Exception):
+  pass
+
+def _walkPair(candidate:Path, expected:Path|TreeSnapshot, ignore:IgnoreRules, max_differences:int|None=None):
+  """
+  Walk both trees at once, in the same order as a recursive dircmp would. `expected` may be a TreeSnapshot.
+  Returns (candidate_only, expected_only, common, truncated) where common is a list of (path, candidate_size, expected_size, same_mtime),
+  and truncated is True if the walk stopped because `max_differences` entries were found only on one side.
+  """
+  left, right, common = [], [], []
+  # The directories are joined as str : the Path operations cost as much as listing them
+  c_root = os.path.join(str(candidate), '')
+  if isinstance(expected, TreeSnapshot) :
+    scanExpected = expected.scan
+  else :
+    e_root = os.path.join(str(expected), '')
+    scanExpected = lambda prefix, ignore : _scanEntries(e_root + str(prefix), ignore, prefix)
+  def inner(prefix:Path):
+    c_entries = _scanEntries(c_root + str(prefix), ignore, prefix)
+    e_entries = scanExpected(prefix, ignore)
+    subdirs = []
+    for name in sorted(c_entries.keys() | e_entries.keys()) :
+      c = c_entries.get(name)
+      e = e_entries.get(name)
+      if e is None :
+        left.append(prefix / name)
+      elif c is None :
+        right.append(prefix / name)
+      elif c[0] and e[0] :
+        subdirs.append(name)
+      elif c[0] or e[0] :
+        # A directory on one side, a file on the other
+        left.append(prefix / name)
+        right.append(prefix / name)
+      else :
+        common.append((prefix / name, c[1], e[1], c[2] == e[2]))
+      if max_differences is not None and len(left) + len(right) >= max_differences :
+        raise _StopWalk()
+    for name in subdirs :
+      inner(prefix / name)
+  try :
+    inner(Path(''))
+  except _StopWalk :
+    return left, right, common, True
+  return left, right, common, False
+
+class DiffResult(tuple):
+  """
+  (candidate_only, expected_only, different) as returned by cmpdir(), with `truncated` True if the comparison stopped at max_differences
+  """
+  def __new__(cls, left:list, right:list, diff:list, truncated:bool=False):
+    self = super().__new__(cls, (left, right, diff))
+    self.truncated = truncated
+    return self
+
+COMPARE_POLICIES = ('stat', 'size+hash', 'full')
+# Minimum number of bytes compared by each task of the thread pool of cmpdir(), and weight of a file smaller than FILE_COST_BYTES.
+# With a warm cache, a task of the pool costs about 10 us, comparing two files of 1 MiB about 180 us,
+# and opening two files about as much as comparing 32 KiB (see the cmpdir phases of benchmarks/bench_expectdir.py)
+PARALLEL_MIN_BYTES = 1 << 20
+FILE_COST_BYTES = 1 << 15
+
+def cmpdir(candidate:Path, expected:Path|TreeSnapshot, workers:int|None=None, chunk_size:int=DEFAULT_CHUNK_SIZE, digests:DigestIndex|None=None, replace:StreamReplacement|None=None, comparators:dict|None=None, stats:dict|None=None, policy:str|None=None, max_differences:int|None=None, ignore:IgnoreRules|Iterable[str]|None=None, normalize:LineNormalizer|None=None):
+  """
+  Compare two directories recursively.
+  Both trees are walked once, files of different size are reported without being read, and the others are compared by chunks in a thread pool,
+  in batches of at least PARALLEL_MIN_BYTES (the small trees are compared in the calling thread).
+  `policy` tells how the content of files of the same size is verified (see COMPARE_POLICIES), it defaults to 'size+hash' if `digests` is passed, else 'full'.
+  With 'size+hash', only the candidate files are read, and compared block by block to the indexed digests of the expected ones.
+  If `replace` is passed, it is applied to the candidate files while they are read, without modifying them.
+  `comparators` maps globs to the Comparator used for the matching files (see resolveComparators()).
+  The number of files compared and the number of bytes of the candidate files read are added to `stats` if passed.
+  If `max_differences` is passed, the walk and the comparisons stop once as many differences are found, and the result is marked as truncated.
+  If `expected` is a TreeSnapshot, the candidate files are compared to its content, without reading the expected directory.
+  The entries matching `ignore` (gitignore-style patterns or IgnoreRules, DEFAULT_IGNORE by default) are skipped, without walking the ignored directories.
+  If `normalize` is passed, the text files of both sides are compared after being normalized line by line.
+  """
+  candidate = Path(candidate)
+  snapshot = None
+  if isinstance(expected, TreeSnapshot) :
+    snapshot = expected
+    expected = snapshot.root
+    digests = None
+  else :
+    expected = Path(expected)
+  comparators = resolveComparators(comparators)
+  if policy is None :
+    policy = 'full' if digests is None else 'size+hash'
+  if policy not in COMPARE_POLICIES :
+    raise ValueError(f'Unknown compare policy {policy!r}, expected one of {COMPARE_POLICIES}')
+  if policy != 'size+hash' :
+    digests = None
+  if ignore is None :
+    ignore = DEFAULT_IGNORE
+  if not hasattr(ignore, 'ignored') :
+    ignore = IgnoreRules(ignore)
+  left, right, common, truncated = _walkPair(candidate, snapshot or expected, ignore, max_differences)
+  diff = []
+  def remaining():
+    return None if max_differences is None else max_differences - len(left) - len(right) - len(diff)
+  to_read = []
+  for p, c_size, e_size, same_mtime in common :
+    if c_size < 0 :
+      diff.append(p)
+    elif replace is not None and replace.applies(p) or comparators and _findComparator(p, comparators) or normalize is not None :
+      # The replacement, the parsing or the normalization may change the size
+      to_read.append(p)
+    elif c_size != e_size :
+      diff.append(p)
+    elif policy == 'stat' and same_mtime :
+      # Like filecmp.cmp(shallow=True)
+      continue
+    else :
+      to_read.append(p)
+  if stats is not None :
+    read = set(to_read)
+    _addStats(stats, len(common), sum(c_size for p, c_size, e_size, same_mtime in common if p in read))
+  if remaining() is not None and remaining() <= 0 :
+    truncated = truncated or bool(to_read) or remaining() < 0
+    to_read = []
+  if to_read :
+    def compare(p):
+      comparator = _findComparator(p, comparators) if comparators else None
+      if comparator is not None :
+        return _structuredEqual(comparator, candidate / p, snapshot if snapshot is not None else expected / p, p, replace)
+      try :
+        if normalize is not None and not isBinaryFile(candidate / p) and not _isBinaryExpected(snapshot or expected, p) :
+          parts = replace.iterFile(candidate / p, chunk_size) if replace is not None and replace.applies(p) else _iterFile(candidate / p, chunk_size)
+          return normalize.digest(parts) == normalize.expectedDigest(snapshot or expected, p)
+        # Joined as str, the Path operations would cost as much as comparing the small files
+        rel = str(p)
+        c_path = c_root + rel
+        if replace is not None and replace.applies(p) :
+          parts = replace.iterFile(c_path, chunk_size)
+        elif snapshot is None and digests is None :
+          return _filesEqual(c_path, e_root + rel, chunk_size)
+        else :
+          parts = _iterFile(c_path, chunk_size)
+        if snapshot is not None :
+          return snapshot.matches(p, parts, policy)
+        if digests is None :
+          return _partsEqualFile(parts, e_root + rel)
+        return digests.matches(e_root + rel, parts)
+      except OSError :
+        return False
+    def collect(results):
+      nonlocal truncated
+      for n, (p, equal) in enumerate(zip(to_read, results)) :
+        if not equal :
+          diff.append(p)
+          if remaining() is not None and remaining() <= 0 :
+            truncated = truncated or n + 1 < len(to_read)
+            return
+    c_root = os.path.join(str(candidate), '')
+    e_root = os.path.join(str(expected), '')
+    # The files are compared in batches of at least PARALLEL_MIN_BYTES (each file weighing at least FILE_COST_BYTES),
+    # so that the small files are not each worth a task of the pool
+    sizes = { p : c_size for p, c_size, e_size, same_mtime in common }
+    batches = [[]]
+    weight = 0
+    for p in to_read :
+      if weight >= PARALLEL_MIN_BYTES :
+        batches.append([])
+        weight = 0
+      batches[-1].append(p)
+      weight += max(sizes[p], FILE_COST_BYTES)
+    if len(batches) == 1 or workers == 1 :
+      collect(map(compare, to_read))
+    else :
+      with ThreadPoolExecutor(max_workers=workers) as executor :
+        futures = [ executor.submit(lambda batch : [ compare(p) for p in batch ], batch) for batch in batches ]
+        try :
+          collect(equal for f in futures for equal in f.result())
+        finally :
+          for f in futures :
+            f.cancel()
+  # Keep the walk order, so that the report is stable
+  order = { p : i for i, (p, _, _, _) in enumerate(common) }
+  diff.sort(key=order.__getitem__)
+  if remaining() is not None and remaining() < 0 :
+    del diff[len(diff) + remaining():]
+  res = DiffResult(left, right, diff, truncated)
   return not any(len(l) for l in res), res
 
 def toBytes(s:object|bytes):
@@ -98,30 +1143,805 @@ def toBytes(s:object|bytes):
     return s
   return str(s).encode('utf8')
 
-def findAndReplaceAllInDir(directory:Path, searched:bytes, replacement:bytes):
-  for dname, dirs, files in os.walk(directory):
-    for fname in files:
-      fpath = os.path.join(dname, fname)
-      with open(fpath, "rb") as f:
-        s = f.read()
-      s = s.replace(searched, replacement)
-      with open(fpath, "wb") as f:
-        f.write(s)
+def _iterReplaced(f, searched:bytes, replacement:bytes, chunk_size:int=DEFAULT_CHUNK_SIZE):
+  """
+  Read `f` by chunks, and yield its content where `searched` is replaced by `replacement`, including the matches spanning two chunks.
+  """
+  keep = len(searched) - 1
+  carry = b''
+  while True :
+    chunk = f.read(chunk_size)
+    if not chunk :
+      if carry :
+        yield carry
+      return
+    buf = carry + chunk
+    pos = 0
+    while True :
+      i = buf.find(searched, pos)
+      if i < 0 :
+        break
+      yield buf[pos:i]
+      yield replacement
+      pos = i + len(searched)
+    # The end of the buffer may be the beginning of a match continuing in the next chunk
+    tail = max(pos, len(buf) - keep)
+    if tail > pos :
+      yield buf[pos:tail]
+    carry = buf[tail:]
+
+def _streamContains(f, searched:bytes, chunk_size:int=DEFAULT_CHUNK_SIZE, head:bytes=b''):
+  keep = len(searched) - 1
+  buf = head
+  while True :
+    if searched in buf :
+      return True
+    chunk = f.read(chunk_size)
+    if not chunk :
+      return False
+    buf = buf[-keep:] + chunk if keep else chunk
+
+def _replaceInFile(fpath:str, searched:bytes, replacement:bytes, binary:bool=True, chunk_size:int=DEFAULT_CHUNK_SIZE):
+  """
+  Replace `searched` by `replacement` in the file, if it contains it. Returns whether it did.
+  The file is rewritten to a temporary file renamed over it, so that a hardlinked file is unlinked instead of being modified in place.
+  """
+  with open(fpath, 'rb') as f :
+    # At least the head checked by isBinaryFile(), so that the files skipped are the ones shown as binary by formatDiff()
+    head = f.read(max(chunk_size, _BINARY_HEAD))
+    if not binary and _isBinaryData(head[:_BINARY_HEAD]) :
+      return False
+    if not _streamContains(f, searched, chunk_size, head) :
+      return False
+  tmp = f'{fpath}.expectdir-tmp'
+  with open(fpath, 'rb') as f, open(tmp, 'wb') as out :
+    for part in _iterReplaced(f, searched, replacement, chunk_size) :
+      out.write(part)
+  shutil.copymode(fpath, tmp)
+  os.replace(tmp, fpath)
+  return True
+
+def _globPatterns(patterns:Iterable[str]|str|None):
+  """
+  The patterns as a tuple, a single pattern being accepted as a str (instead of being iterated character by character)
+  """
+  if patterns is None :
+    return None
+  if isinstance(patterns, str) :
+    return (patterns,)
+  return tuple(patterns)
+
+def _globMatch(rel:PurePosixPath, patterns:Iterable[str]):
+  return any(rel.match(p) for p in patterns)
+
+def findAndReplaceAllInDir(directory:Path, searched:bytes, replacement:bytes, include:Iterable[str]|None=None, exclude:Iterable[str]|None=None, binary:bool=True, files:Iterable[Path]|None=None, chunk_size:int=DEFAULT_CHUNK_SIZE, stats:dict|None=None):
+  """
+  Replace `searched` by `replacement` in the files of `directory`, by streaming them, and rewriting only those containing `searched`.
+  `include` and `exclude` are glob patterns matched against the path relative to `directory`, `binary=False` skips the binary files (like isBinaryFile()), and `files` restricts the search to the given relative paths.
+  Returns the list of the relative paths of the files where a replacement has been done.
+  The number of files and bytes scanned are added to `stats` if passed.
+  """
+  if files is None :
+    files = []
+    for dname, dirs, fnames in os.walk(directory) :
+      dirs.sort()
+      rel = Path(os.path.relpath(dname, directory))
+      files.extend(rel / fname for fname in sorted(fnames))
+  selection = StreamReplacement(searched, replacement, include, exclude, binary)
+  replaced = []
+  for rel in files :
+    rel = Path(rel)
+    if not selection.applies(rel) :
+      continue
+    _addStats(stats, 1, os.stat(os.path.join(directory, rel)).st_size)
+    if _replaceInFile(os.path.join(directory, rel), searched, replacement, binary, chunk_size) :
+      replaced.append(rel)
+  return replaced
+
+class StreamReplacement(object):
+  """
+  Replacement of `searched` by `replacement` applied to the files while they are read, so that they don't need to be rewritten.
+  `include`, `exclude` and `binary` select the files like for findAndReplaceAllInDir().
+  """
+  def __init__(self, searched:bytes, replacement:bytes, include:Iterable[str]|None=None, exclude:Iterable[str]|None=None, binary:bool=True):
+    self.searched = searched
+    self.replacement = replacement
+    self.include = _globPatterns(include)
+    self.exclude = _globPatterns(exclude)
+    self.binary = binary
+
+  def applies(self, rel:Path):
+    posix = PurePosixPath(Path(rel).as_posix())
+    if self.include is not None and not _globMatch(posix, self.include) :
+      return False
+    return self.exclude is None or not _globMatch(posix, self.exclude)
+
+  def iterFile(self, path:Path, chunk_size:int=DEFAULT_CHUNK_SIZE):
+    with open(path, 'rb') as f :
+      head = f.read(max(chunk_size, _BINARY_HEAD))
+      if not self.binary and _isBinaryData(head[:_BINARY_HEAD]) :
+        yield head
+        yield from iter(lambda : f.read(chunk_size), b'')
+        return
+      yield from _iterReplaced(_PrefixedReader(head, f), self.searched, self.replacement, chunk_size)
+
+  def read(self, path:Path):
+    return b''.join(self.iterFile(path))
+
+class _PrefixedReader(object):
+  """
+  File-like object yielding `head`, then the rest of `f`
+  """
+  def __init__(self, head:bytes, f):
+    self.head = head
+    self.f = f
+
+  def read(self, size:int):
+    if self.head :
+      res, self.head = self.head, b''
+      return res
+    return self.f.read(size)
+
+def _normalizeEol(line:bytes):
+  return line.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+def _normalizeTrailingWhitespace(line:bytes):
+  content = line.rstrip(b'\r\n')
+  return content.rstrip(b' \t') + line[len(content):]
+
+NORMALIZERS = {
+  'eol' : _normalizeEol,
+  'trailing-whitespace' : _normalizeTrailingWhitespace,
+}
+
+class LineNormalizer(object):
+  """
+  Transform applied to each line of the text files of both sides before they are compared and diffed.
+  `rules` are names of NORMALIZERS, regex masks (str, bytes or compiled pattern, whose matches are replaced by `<masked>`),
+  or (regex, replacement) tuples, applied in order.
+  The digests of the normalized expected files are cached, keyed by path, size and mtime.
+  """
+  MASK = b'<masked>'
+  CACHE_SIZE = 4096
+  def __init__(self, rules:Iterable):
+    self.transforms = []
+    for rule in rules :
+      if isinstance(rule, str) and rule in NORMALIZERS :
+        self.transforms.append(NORMALIZERS[rule])
+        continue
+      replacement = self.MASK
+      if isinstance(rule, tuple) :
+        rule, replacement = rule
+      if isinstance(rule, str) :
+        rule = rule.encode('utf8')
+      if not hasattr(rule, 'sub') :
+        rule = re.compile(rule)
+      elif isinstance(rule.pattern, str) :
+        # The lines are bytes : compile the same pattern for bytes
+        rule = re.compile(rule.pattern.encode('utf8'), rule.flags & ~re.UNICODE)
+      self.transforms.append(lambda line, regex=rule, replacement=toBytes(replacement) : regex.sub(replacement, line))
+    self.cache = OrderedDict()
+    self.lock = threading.Lock()
+
+  def line(self, line:bytes):
+    for transform in self.transforms :
+      line = transform(line)
+    return line
+
+  def iterFile(self, parts:Iterable[bytes]):
+    """
+    Normalize a stream of bytes line by line
+    """
+    pending = []
+    for part in parts :
+      end = part.rfind(b'\n')
+      if end < 0 :
+        pending.append(part)
+        continue
+      pending.append(part[:end + 1])
+      for line in b''.join(pending).splitlines(keepends=True) :
+        yield self.line(line)
+      pending = [part[end + 1:]]
+    rest = b''.join(pending)
+    if rest :
+      yield self.line(rest)
+
+  def expectedDigest(self, expected:Path|TreeSnapshot, rel:Path):
+    """
+    Digest of the normalized content of the expected file `rel`, cached
+    """
+    if isinstance(expected, TreeSnapshot) :
+      key = (str(expected.root.absolute()), str(rel), None)
+      parts = lambda : (expected.read(rel),)
+    else :
+      path = expected / rel
+      st = os.stat(path)
+      key = (str(path.absolute()), st.st_size, st.st_mtime_ns)
+      parts = lambda : _iterFile(path)
+    with self.lock :
+      if key in self.cache :
+        self.cache.move_to_end(key)
+        return self.cache[key]
+    digest = self.digest(parts())
+    with self.lock :
+      self.cache[key] = digest
+      if len(self.cache) > self.CACHE_SIZE :
+        self.cache.popitem(last=False)
+    return digest
+
+  def digest(self, parts:Iterable[bytes]):
+    h = hashlib.blake2b(digest_size=16)
+    for line in self.iterFile(parts) :
+      h.update(line)
+    return h.hexdigest()
+
+def _isBinaryExpected(expected:Path|TreeSnapshot, rel:Path):
+  if isinstance(expected, TreeSnapshot) :
+    return _isBinaryData(bytes(expected.read(rel)[:_BINARY_HEAD]))
+  return isBinaryFile(expected / rel)
+
+def _statTree(directory:Path):
+  """
+  Return {relative path: stat signature} of the files in `directory`
+  """
+  res = {}
+  for dname, dirs, fnames in os.walk(directory) :
+    rel = Path(os.path.relpath(dname, directory))
+    for fname in fnames :
+      st = os.stat(os.path.join(dname, fname))
+      res[rel / fname] = (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+  return res
+
+def _changedFiles(directory:Path, before:dict, since_ns:int, always:Iterable[Path]=()):
+  """
+  List the files of `directory` that were added or modified since `before` was taken by _statTree() at `since_ns`, plus the ones of `always` that still exist.
+  Like git does for its index, files modified too close to `since_ns` are always listed, in case the file system timestamps are coarse.
+  """
+  racy = since_ns - 2 * 10**9
+  always = set(always)
+  return [
+    rel for rel, sig in _statTree(directory).items()
+    if rel in always or before.get(rel) != sig or sig[1] >= racy
+  ]
+
+MATERIALIZE_STRATEGIES = ('auto', 'copy', 'hardlink')
+_FICLONE = 0x40049409
+
+def _reflinkFile(src:str, dst:str):
+  """
+  Clone `src` to `dst` sharing the same extents (copy-on-write), on file systems supporting it (btrfs, xfs...).
+  """
+  if fcntl is None : # pragma: no cover
+    raise OSError('reflinks are not supported on this platform')
+  with open(src, 'rb') as fs, open(dst, 'wb') as fd :
+    fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+  shutil.copystat(src, dst)
+
+class _TreeCopier(object):
+  """
+  copy_function for shutil.copytree that tries the cheapest method first, and counts the methods actually used.
+  A method failing once is not tried again for the rest of the tree.
+  """
+  def __init__(self, strategy:str):
+    if strategy not in MATERIALIZE_STRATEGIES :
+      raise ValueError(f'Unknown materialization strategy {strategy!r}, expected one of {MATERIALIZE_STRATEGIES}')
+    self.hardlink = strategy == 'hardlink'
+    self.reflink = strategy == 'auto' and fcntl is not None
+    self.methods = {}
+    self.bytes = 0
+
+  def _done(self, method:str, dst:str):
+    self.methods[method] = self.methods.get(method, 0) + 1
+    self.bytes += os.stat(dst).st_size
+    return dst
+
+  def __call__(self, src:str, dst:str):
+    if self.hardlink :
+      try :
+        os.link(src, dst)
+        return self._done('hardlink', dst)
+      except OSError :
+        self.hardlink = False
+    if self.reflink :
+      try :
+        _reflinkFile(src, dst)
+        return self._done('reflink', dst)
+      except OSError :
+        self.reflink = False
+    shutil.copy2(src, dst)
+    return self._done('copy', dst)
+
+def _addStats(stats:dict|None, files:int, bytes:int):
+  if stats is not None :
+    stats['files'] = stats.get('files', 0) + files
+    stats['bytes'] = stats.get('bytes', 0) + bytes
+
+def materializeTree(src:Path, dst:Path, strategy:str='auto', stats:dict|None=None):
+  """
+  Copy the tree `src` to `dst` (which must not exist) using `strategy`, and return how many files were materialized by each method.
+  The number of files and bytes copied are added to `stats` if passed.
+  """
+  copier = _TreeCopier(strategy)
+  shutil.copytree(_win32_longpath(str(src)), _win32_longpath(str(dst)), copy_function=copier)
+  _addStats(stats, sum(copier.methods.values()), copier.bytes)
+  return copier.methods
+
+def _writeUpdated(src:Path, dst:Path, rel:Path, replace:StreamReplacement|None):
+  if replace is not None and replace.applies(rel) :
+    with open(dst, 'wb') as f :
+      for part in replace.iterFile(src) :
+        f.write(part)
+    shutil.copymode(src, dst)
+  else :
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+  return os.stat(dst).st_size
+
+def updateTree(candidate:Path, expected:Path, diffRes, replace:StreamReplacement|None=None, stats:dict|None=None, ignore:IgnoreRules|None=None):
+  """
+  Make `expected` equal to `candidate`, writing only the entries listed in `diffRes` (the complete result of cmpdir()).
+  `replace` is applied to the candidate files while they are written. The `.gitkeep` files are kept, and one is added to the empty directories.
+  The entries matching `ignore` in the new directories are not copied.
+  The number of files written and their bytes are added to `stats` if passed.
+  """
+  left, right, diff = diffRes
+  files = written = 0
+  touched = set()
+  for p in right :
+    path = expected / p
+    if path.is_dir() and not path.is_symlink() :
+      shutil.rmtree(path)
+    else :
+      path.unlink()
+    touched.add(path.parent)
+  for p in left :
+    src = candidate / p
+    if src.is_dir() :
+      for root, dirs, names in os.walk(src) :
+        root = Path(root)
+        rel = p / root.relative_to(src)
+        if ignore is not None :
+          dirs[:] = [ d for d in dirs if not ignore.ignored(rel / d, True) ]
+          names = [ n for n in names if not ignore.ignored(rel / n, False) ]
+        dst = expected / rel
+        dst.mkdir()
+        touched.add(dst)
+        for name in names :
+          written += _writeUpdated(root / name, dst / name, p / root.relative_to(src) / name, replace)
+          files += 1
+    else :
+      written += _writeUpdated(src, expected / p, p, replace)
+      files += 1
+  for p in diff :
+    written += _writeUpdated(candidate / p, expected / p, p, replace)
+    files += 1
+  for directory in touched :
+    if directory.is_dir() and not any(os.scandir(directory)) :
+      (directory / GITKEEP).touch()
+  _addStats(stats, files, written)
+
+class TreeSnapshot(object):
+  """
+  In-memory copy of a directory tree : the entries of each directory (like _scanEntries()), and the content of the files.
+  It can be materialized, and passed as the expected tree of cmpdir(), without listing or reading the directory again.
+  Raises ValueError if the files of the tree weigh more than `max_bytes`.
+  """
+  def __init__(self, root:Path, max_bytes:int|None=None):
+    self.root = Path(root)
+    self.entries = {} # relative dir path -> {name: (is_dir, size, mtime_ns)}
+    self.files = {} # relative path -> (content, mode)
+    self.size = 0
+    self._load(Path(''), max_bytes)
+
+  def _load(self, prefix:Path, max_bytes:int|None):
+    entries = self.entries[prefix] = _scanEntries(self.root / prefix)
+    for name, (is_dir, size, mtime_ns) in entries.items() :
+      if is_dir :
+        self._load(prefix / name, max_bytes)
+        continue
+      self.size += size
+      if max_bytes is not None and self.size > max_bytes :
+        raise ValueError(f'{self.root} weighs more than {max_bytes} bytes')
+      path = self.root / prefix / name
+      with open(path, 'rb') as f :
+        self.files[prefix / name] = (f.read(), os.fstat(f.fileno()).st_mode)
+
+  def scan(self, prefix:Path, ignore:IgnoreRules|None=None):
+    """
+    Same as _scanEntries(self.root / prefix, ignore, prefix), without listing the directory
+    """
+    if ignore is None :
+      return self.entries[prefix]
+    base = _posixPrefix(prefix)
+    return { name : entry for name, entry in self.entries[prefix].items() if not ignore._ignoredPosix(base + name, entry[0]) }
+
+  def isDir(self, p:Path):
+    return p in self.entries
+
+  def read(self, p:Path):
+    """
+    Content of the file `p` (relative to the root)
+    """
+    return self.files[p][0]
+
+  def mode(self, p:Path):
+    return self.files[p][1]
+
+  def matches(self, p:Path, parts:Iterable[bytes], policy:str='full'):
+    """
+    Whether the stream of bytes `parts` has the same content as the file `p`, stopping at the first difference
+    """
+    return _partsEqualBytes(parts, self.read(p))
+
+  def materialize(self, dst:Path, stats:dict|None=None):
+    """
+    Write the tree to `dst` (which must not exist), and return how many files were written, like materializeTree()
+    """
+    for prefix in self.entries :
+      (dst / prefix).mkdir()
+    for p in self.files :
+      mode = self.mode(p)
+      with open(dst / p, 'wb') as f :
+        f.write(self.read(p))
+      if mode & 0o111 :
+        # Not os.fchmod(), that is missing on Windows before python 3.13
+        os.chmod(dst / p, mode & 0o7777)
+    _addStats(stats, len(self.files), self.size)
+    return { 'snapshot' : len(self.files) }
+
+  def close(self):
+    pass
+
+ARCHIVE_SUFFIXES = ('.tar', '.zip')
+
+class ArchiveTree(TreeSnapshot):
+  """
+  Index of a tar or zip archive, used like a TreeSnapshot, without extracting it : the archive is mapped in memory,
+  and the content of a member is only read when it is compared or diffed.
+  The members of an uncompressed tar, and the stored members of a zip are sliced from the map without copy.
+  The CRC32 of the compressed zip members lets the size+hash policy reject the different candidate files without decompressing them.
+  """
+  def __init__(self, path:Path):
+    self.root = Path(path)
+    self.entries = { Path('') : {} }
+    self.files = {} # relative path -> (offset, size, mode, crc32 or None, zip member name if compressed)
+    self.size = 0
+    self.lock = threading.Lock()
+    self.zip = None
+    with open(self.root, 'rb') as f :
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+    if zipfile.is_zipfile(str(self.root)) :
+      self._loadZip()
+    else :
+      self._loadTar()
+
+  def _add(self, name:str, is_dir:bool, size:int=0, info=None):
+    p = Path(PurePosixPath(name.strip('/')))
+    if p.parts and p.parts[0] == '.' :
+      p = Path(*p.parts[1:])
+    if not p.parts :
+      return
+    for parent in reversed(p.parents) :
+      if parent not in self.entries :
+        self.entries[parent.parent][parent.name] = (True, 0, 0)
+        self.entries[parent] = {}
+    if is_dir :
+      if p not in self.entries :
+        self.entries[p.parent][p.name] = (True, 0, 0)
+        self.entries[p] = {}
+      return
+    # The mtimes of the members are not comparable to the ones of the candidate, so that the stat policy reads the files
+    self.entries[p.parent][p.name] = (False, size, -1)
+    self.files[p] = info
+    self.size += size
+
+  def _loadTar(self):
+    try :
+      tar = tarfile.open(str(self.root), 'r:')
+    except tarfile.TarError as e :
+      raise ValueError(f'{self.root} is not an uncompressed tar or a zip archive : {e}')
+    with tar :
+      for member in tar :
+        if member.isdir() :
+          self._add(member.name, True)
+        elif member.isfile() :
+          self._add(member.name, False, member.size, (member.offset_data, member.size, member.mode, None, None))
+
+  def _loadZip(self):
+    self.zip = zipfile.ZipFile(str(self.root))
+    for info in self.zip.infolist() :
+      if info.is_dir() :
+        self._add(info.filename, True)
+        continue
+      # The data follows the local header, whose name and extra field may differ from the central directory ones
+      name_length, extra_length = struct.unpack('<HH', self.map[info.header_offset + 26:info.header_offset + 30])
+      offset = info.header_offset + 30 + name_length + extra_length
+      compressed = info.filename if info.compress_type != zipfile.ZIP_STORED else None
+      self._add(info.filename, False, info.file_size, (offset, info.file_size, info.external_attr >> 16, info.CRC, compressed))
+
+  def read(self, p:Path):
+    offset, size, mode, crc, compressed = self.files[p]
+    if compressed is not None :
+      with self.lock :
+        return self.zip.read(compressed)
+    return memoryview(self.map)[offset:offset + size]
+
+  def mode(self, p:Path):
+    return self.files[p][2] or 0o644
+
+  def matches(self, p:Path, parts:Iterable[bytes], policy:str='full'):
+    offset, size, mode, crc, compressed = self.files[p]
+    if policy != 'size+hash' or crc is None or compressed is None :
+      # The stored members are compared without copy anyway
+      return super().matches(p, parts, policy)
+    # The CRC32 only rejects the different files without decompressing the member, the equal ones are verified byte by byte
+    # (the candidate is kept, but so would be the decompressed member)
+    value = 0
+    kept = []
+    for part in parts :
+      value = zlib.crc32(part, value)
+      kept.append(part)
+    return value == crc and super().matches(p, kept, policy)
+
+  def close(self):
+    if self.zip is not None :
+      self.zip.close()
+    if isinstance(self.map, mmap.mmap) :
+      self.map.close()
+
+def _isArchive(path:Path):
+  return Path(path).suffix in ARCHIVE_SUFFIXES and Path(path).is_file()
+
+def _findTree(path:Path):
+  """
+  Return `path` if it is a directory or an archive, else the archive `path`.tar or `path`.zip if one exists, else None
+  """
+  if path.is_dir() or _isArchive(path) :
+    return path
+  for suffix in ARCHIVE_SUFFIXES :
+    archive = path.with_name(path.name + suffix)
+    if archive.is_file() :
+      return archive
+  return None
+
+class _SnapshotCache(object):
+  """
+  Session cache of the TreeSnapshot of the initial and expected directories, and of the tmpfs directory where the candidates are put
+  """
+  SHM = Path('/dev/shm')
+  def __init__(self, max_bytes:int|None):
+    self.max_bytes = max_bytes
+    self.snapshots = {}
+    self.lock = threading.Lock()
+    self.shm = None
+
+  def get(self, root:Path):
+    """
+    Return the snapshot of `root` (an ArchiveTree if it is an archive), or None if it is too big
+    """
+    key = str(Path(root).absolute())
+    with self.lock :
+      if key not in self.snapshots :
+        if _isArchive(root) :
+          self.snapshots[key] = ArchiveTree(root)
+        else :
+          try :
+            self.snapshots[key] = TreeSnapshot(root, self.max_bytes)
+          except ValueError :
+            self.snapshots[key] = None
+      return self.snapshots[key]
+
+  def discard(self, root:Path):
+    """
+    Forget the snapshot of `root`, after it was modified
+    """
+    with self.lock :
+      self.snapshots.pop(str(Path(root).absolute()), None)
+
+  def candidateRoot(self, tmp_path:Path):
+    """
+    Directory where the candidates of the test using `tmp_path` are put : on tmpfs if available, else `tmp_path`
+    """
+    with self.lock :
+      if self.shm is None :
+        try :
+          self.shm = Path(tempfile.mkdtemp(prefix='pytest-expectdir-', dir=str(self.SHM)))
+        except OSError :
+          self.shm = False
+    if not self.shm :
+      return tmp_path
+    return self.shm / tmp_path.name
+
+  def close(self):
+    if self.shm :
+      shutil.rmtree(self.shm, ignore_errors=True)
+    self.shm = None
+    for snapshot in self.snapshots.values() :
+      if snapshot is not None :
+        snapshot.close()
+    self.snapshots.clear()
+
+class _Template(object):
+  def __init__(self, path:Path, index:list, size:int):
+    self.path = path
+    self.index = index
+    self.size = size
+    self.users = 0
+
+class _TemplateCache(object):
+  """
+  Session cache of the initial directories materialized once (the templates), with the index of their files containing current_dir_replace_string,
+  so that the candidates are cloned from them, and only the indexed files are searched for the replacement.
+  A template is only built the second time an initial directory is used : for the ones used once, it would be a copy more.
+  The least recently used templates are evicted once they weigh more than `max_bytes`.
+  """
+  def __init__(self, max_bytes:int|None):
+    self.max_bytes = max_bytes
+    self.templates = OrderedDict() # key -> _Template, or None if the tree is too big
+    self.seen = set() # keys used once, without template yet
+    self.size = 0
+    self.root = None
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def _build(self, initial:Path, alias:bytes|None, replace_kwargs:dict, tmp_path_factory):
+    with self.lock :
+      if self.root is None :
+        self.root = tmp_path_factory.mktemp('expectdir-templates')
+      self.count += 1
+      path = self.root / f'template{self.count}'
+    stats = {}
+    materializeTree(initial, path, 'auto', stats=stats)
+    size = stats.get('bytes', 0)
+    if self.max_bytes is not None and size > self.max_bytes :
+      shutil.rmtree(path, ignore_errors=True)
+      return None
+    index = []
+    if alias :
+      selection = StreamReplacement(alias, alias, **replace_kwargs)
+      for dname, dirs, fnames in os.walk(path) :
+        dirs.sort()
+        rel = Path(os.path.relpath(dname, path))
+        for fname in sorted(fnames) :
+          if selection.applies(rel / fname) :
+            with open(os.path.join(dname, fname), 'rb') as f :
+              if _streamContains(f, alias) :
+                index.append(rel / fname)
+    return _Template(path, index, size)
+
+  def _evict(self):
+    # Called with the lock held
+    for key, template in list(self.templates.items()) :
+      if self.max_bytes is None or self.size <= self.max_bytes :
+        return
+      if template is not None and template.users == 0 :
+        del self.templates[key]
+        self.size -= template.size
+        shutil.rmtree(template.path, ignore_errors=True)
+
+  def clone(self, initial:Path, dst:Path, strategy:str, alias:bytes|None, replace_kwargs:dict, tmp_path_factory, stats:dict|None=None):
+    """
+    Materialize `initial` to `dst` from its template, and return (materialized methods, files of `dst` containing `alias`),
+    or None if the tree is too big to be cached, or if it is its first use
+    """
+    key = (str(Path(initial).absolute()), alias, _globPatterns(replace_kwargs['include']), _globPatterns(replace_kwargs['exclude']), replace_kwargs['binary'])
+    with self.lock :
+      if key in self.templates :
+        self.templates.move_to_end(key)
+        template = self.templates[key]
+        if template is None :
+          return None
+        template.users += 1
+      elif key not in self.seen :
+        self.seen.add(key)
+        return None
+      else :
+        template = False
+    if template is False :
+      template = self._build(initial, alias, replace_kwargs, tmp_path_factory)
+      with self.lock :
+        if key in self.templates :
+          # Built by another thread in the meantime
+          if template is not None :
+            shutil.rmtree(template.path, ignore_errors=True)
+          template = self.templates[key]
+          if template is None :
+            return None
+        else :
+          self.templates[key] = template
+          if template is None :
+            return None
+          self.size += template.size
+        template.users += 1
+    try :
+      return materializeTree(template.path, dst, strategy, stats=stats), template.index
+    finally :
+      with self.lock :
+        template.users -= 1
+        self._evict()
+
+  def close(self):
+    if self.root is not None :
+      shutil.rmtree(self.root, ignore_errors=True)
+    self.root = None
+    self.templates.clear()
+    self.seen.clear()
+    self.size = 0
 
 class _ExpectDirCounter(object):
   """
-  Descriptor to use a common counter on ExpectDir instances using the same path
+  Descriptor to use a common counter on ExpectDir instances using the same path.
+  It is thread safe, so that tests run by threaded runners get distinct candidate directories.
   """
   def __init__(self):
     self.counters = {}
+    self.lock = threading.Lock()
 
   def __get__(self, obj:'ExpectDir', objtype=None):
     if obj is None :
       return self.counters
-    return self.counters.setdefault(str(obj.tmp_path.absolute()), -1)
+    with self.lock :
+      return self.counters.setdefault(str(obj.tmp_path.absolute()), -1)
   
   def __set__(self, obj:'ExpectDir', objvalue):
-    self.counters[str(obj.tmp_path.absolute())] = objvalue
+    with self.lock :
+      self.counters[str(obj.tmp_path.absolute())] = objvalue
+
+  def increment(self, obj:'ExpectDir'):
+    """
+    Atomically increment the counter of `obj` and return its new value
+    """
+    key = str(obj.tmp_path.absolute())
+    with self.lock :
+      value = self.counters[key] = self.counters.get(key, -1) + 1
+      return value
+
+def _iniLimit(config, name:str):
+  """
+  Read an integer ini option where 0 means unlimited
+  """
+  value = int(config.getini(name))
+  return value if value > 0 else None
+
+def _iniMapping(config, name:str):
+  """
+  Read a linelist ini option of `key = value` lines as a list of (key, value)
+  """
+  res = []
+  for line in config.getini(name) :
+    key, sep, value = line.partition('=')
+    if not sep :
+      raise ValueError(f'Invalid line {line!r} in the {name} ini option, expected "key = value"')
+    res.append((key.strip(), value.strip()))
+  return res
+
+_PROPERTY_PREFIX = 'expectdir:'
+
+class _DurationsReporter(object):
+  """
+  Plugin collecting the phases of the expectdir blocks, and showing the slowest ones in the terminal summary (--expectdir-durations)
+  """
+  def __init__(self, count:int):
+    self.count = count
+    self.blocks = []
+
+  def pytest_runtest_logreport(self, report):
+    # The phases are read from the reports so that the blocks run by xdist workers are summarized too
+    if report.when != 'teardown' :
+      return
+    for name, value in report.user_properties :
+      if isinstance(name, str) and name.startswith(_PROPERTY_PREFIX) :
+        self.blocks.append((report.nodeid, name[len(_PROPERTY_PREFIX):], json.loads(value)))
+
+  def pytest_terminal_summary(self, terminalreporter):
+    total = lambda phases : sum(p['duration'] for p in phases.values())
+    blocks = sorted(self.blocks, key=lambda b : total(b[2]), reverse=True)
+    if self.count > 0 :
+      blocks = blocks[:self.count]
+    terminalreporter.write_sep('=', f'slowest {f"{self.count} " if self.count else ""}expectdir blocks')
+    for nodeid, candidate, phases in blocks :
+      details = ', '.join(f'{name} {p["duration"]:.2f}s ({p["files"]} files, {p["bytes"]} B)' for name, p in phases.items())
+      terminalreporter.write_line(f'{total(phases):.2f}s {nodeid} [{candidate}] : {details}')
 
 class ExpectDir(object):
   """
@@ -129,8 +1949,9 @@ class ExpectDir(object):
   """
   EMPTY = '__empty__'
   current = _ExpectDirCounter()
-  def __init__(self, tmp_path:Path, request, default_current_dir_replace_string=None):
+  def __init__(self, tmp_path:Path, request, default_current_dir_replace_string=None, tmp_path_factory=None):
     self.tmp_path = tmp_path
+    self.tmp_path_factory = tmp_path_factory
     currentFile = Path(request.module.__file__)
     self.cwd = currentFile.parent
     self.fallback = Path(currentFile.stem)
@@ -139,13 +1960,79 @@ class ExpectDir(object):
     if request.function :
       self.fallback = self.fallback / request.function.__name__
     self.default_current_dir_replace_string = default_current_dir_replace_string
+    self.digests = getattr(request.config, '_expectdir_digests', None)
+    self.snapshots = getattr(request.config, '_expectdir_snapshots', None)
+    self.default_snapshot = request.config.getini('expectdir_snapshot')
+    self.update = request.config.getoption('expectdir_update')
+    self.templates = getattr(request.config, '_expectdir_templates', None)
+    self.ignore = getattr(request.config, '_expectdir_ignore', None) or IgnoreRules()
+    # Shared by the tests of the session, so that the digests of the normalized expected files are cached
+    self.normalizers = getattr(request.config, '_expectdir_normalizers', {})
+    self.default_materialize = request.config.getini('expectdir_materialize') or 'auto'
+    self.default_fused_replace = request.config.getini('expectdir_fused_replace')
+    self.default_comparators = _iniMapping(request.config, 'expectdir_comparators')
+    self.default_policy = request.config.getini('expectdir_compare_policy') or 'full'
+    self.default_max_differences = _iniLimit(request.config, 'expectdir_max_differences')
+    self.diff_options = {
+      'max_files' : _iniLimit(request.config, 'expectdir_diff_max_files'),
+      'max_bytes' : _iniLimit(request.config, 'expectdir_diff_max_bytes'),
+      'max_report' : _iniLimit(request.config, 'expectdir_diff_max_report'),
+      'algorithm' : request.config.getini('expectdir_diff_algorithm') or 'auto',
+      'timeout' : float(request.config.getini('expectdir_diff_timeout')) or None,
+      'intraline' : request.config.getini('expectdir_diff_intraline'),
+    }
+    self.materialized = {}
+    self.phases = {}
+    self.node = request.node
+    self.hook = request.config.hook
     self.tmp_dir = None
 
+  def _allocateCandidate(self, root:Path):
+    """
+    Return the path of a new candidate directory in `root`, not used by any other call, even from another thread
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    counter = ExpectDir.__dict__['current']
+    while True :
+      candidate = root / f'candidate{counter.increment(self)}'
+      if not candidate.exists() :
+        return candidate
+
   @contextmanager
-  def __call__(self, datapath=None, initial=None, expected=None, current_dir_replace_string=None):
+  def _phase(self, block:'_Block', phase:str):
+    """
+    Time a phase of the with block, and report it to the pytest_expectdir_phase hook
+    """
+    stats = { 'files' : 0, 'bytes' : 0 }
+    start = time.perf_counter()
+    yield stats
+    duration = time.perf_counter() - start
+    block.phases[phase] = dict(duration=duration, **stats)
+    self.hook.pytest_expectdir_phase(item=self.node, candidate=block.tmp_dir, phase=phase, duration=duration, bytes=stats['bytes'], files=stats['files'])
+
+  def _prepare(self, datapath=None, initial=None, expected=None, current_dir_replace_string=None, materialize=None, replace_include=None, replace_exclude=None, replace_binary=True, fused_replace=None, comparators=None, policy=None, fail_fast=False, max_differences=None, snapshot=None, ignore=None, normalize=None):
+    """
+    Resolve the arguments of a with block, and check the directories exist
+    """
     if current_dir_replace_string is None :
       current_dir_replace_string = self.default_current_dir_replace_string
-    self.current += 1
+    if fused_replace is None :
+      fused_replace = self.default_fused_replace
+    # The comparators passed explicitly have the priority over the ini ones
+    comparators = resolveComparators(comparators) + resolveComparators(self.default_comparators)
+    if materialize is None :
+      materialize = self.default_materialize
+    if policy is None :
+      policy = self.default_policy
+    if fail_fast :
+      max_differences = 1
+    elif max_differences is None :
+      max_differences = self.default_max_differences
+    if snapshot is None :
+      snapshot = self.default_snapshot
+    if self.update :
+      # The update needs all the differences
+      max_differences = None
     if not expected :
       if not datapath :
         datapath = self.fallback
@@ -154,60 +2041,265 @@ class ExpectDir(object):
       expected = Path(expected)
       if not initial and not datapath :
         initial = ExpectDir.EMPTY
-    if not (self.cwd / expected).is_dir() :
+    # The directories may also be packed as archives (see ArchiveTree)
+    expected_path = _findTree(self.cwd / expected)
+    if expected_path is None and self.update :
+      # Created by _check() for the new tests, once the with block succeeded
+      expected_path = self.cwd / expected
+    if expected_path is None :
       raise FileNotFoundError(f'{self.cwd / expected} (as expected directory for expectdir) is not a directory ')
       
     if not initial :
-      initial = Path(datapath) / "initial"
-      if not (self.cwd / initial).is_dir() :
-        initial = None
+      initial = _findTree(self.cwd / datapath / "initial")
     elif initial == ExpectDir.EMPTY :
       initial = None
     else :
       initial = Path(initial)
-      if not (self.cwd / initial).is_dir() :
+      if not (self.cwd / initial).is_dir() and not _isArchive(self.cwd / initial) :
         raise FileNotFoundError(f'{self.cwd / initial} (as initial directory for expectdir) is not a directory whereas it has been passed explicitely as kwarg.')
-        
+      initial = self.cwd / initial
     
-    try :
-      self.tmp_dir = self.tmp_path / f'candidate{self.current}'
-      self.tmp_dir.parent.mkdir(parents=True, exist_ok=True)
-      if initial :
-        shutil.copytree(
-          _win32_longpath(str(self.cwd / initial)), _win32_longpath(str(self.tmp_dir))
-        )
+    block = _Block()
+    block.initial = initial
+    block.expected = expected_path
+    block.alias = toBytes(current_dir_replace_string) if current_dir_replace_string else None
+    block.materialize = materialize
+    block.replace_kwargs = dict(include=_globPatterns(replace_include), exclude=_globPatterns(replace_exclude), binary=replace_binary)
+    block.fused_replace = fused_replace
+    block.comparators = comparators
+    block.policy = policy
+    block.max_differences = max_differences
+    block.ignore = self.ignore.extend(ignore)
+    block.normalize = self._normalizer(normalize)
+    block.root = self.tmp_path
+    block.snapshot_mode = bool(snapshot) and self.snapshots is not None
+    # The attributes of the fixture show the last block
+    self.phases = block.phases
+    self.materialized = block.materialized
+    return block
+
+  def _normalizer(self, normalize):
+    if not normalize or isinstance(normalize, LineNormalizer) :
+      return normalize or None
+    if isinstance(normalize, str) :
+      normalize = [normalize]
+    key = tuple(normalize)
+    normalizer = self.normalizers.get(key)
+    if normalizer is None :
+      # setdefault is atomic, so that the threads get the same normalizer
+      normalizer = self.normalizers.setdefault(key, LineNormalizer(key))
+    return normalizer
+
+  def _loadTrees(self, block:'_Block'):
+    """
+    Load the snapshots of the initial and expected trees of `block` in snapshot mode, and index the archives
+    """
+    if block.snapshot_mode :
+      # The trees too big to be kept in memory are read from the disk as usual
+      block.root = self.snapshots.candidateRoot(self.tmp_path)
+      block.initial_tree = block.initial and self.snapshots.get(block.initial)
+      block.expected_tree = self.snapshots.get(block.expected) if block.expected.exists() else None
+    # The archives are always indexed, whatever the mode
+    for name in ('initial', 'expected') :
+      path = getattr(block, name)
+      if path and _isArchive(path) :
+        setattr(block, f'{name}_tree', self.snapshots.get(path) if self.snapshots is not None else ArchiveTree(path))
+
+  def _setUp(self, block:'_Block'):
+    """
+    Load the trees of `block`, materialize its candidate directory, and replace the alias by its path
+    """
+    self._loadTrees(block)
+    block.tmp_dir = self._allocateCandidate(block.root)
+    files = None
+    with self._phase(block, 'materialize') as stats :
+      if block.initial_tree :
+        block.materialized.update(block.initial_tree.materialize(block.tmp_dir, stats=stats))
+      elif block.initial :
+        cloned = None
+        if self.templates is not None and self.tmp_path_factory is not None and block.materialize != 'hardlink' :
+          # With hardlinks, the files modified in place by the tested code would corrupt the template
+          cloned = self.templates.clone(block.initial, block.tmp_dir, block.materialize, block.alias, block.replace_kwargs, self.tmp_path_factory, stats=stats)
+        if cloned is not None :
+          methods, files = cloned
+        else :
+          methods, files = materializeTree(block.initial, block.tmp_dir, block.materialize, stats=stats), None
+        block.materialized.update(methods)
       else :
-        self.tmp_dir.mkdir()
-      if current_dir_replace_string :
-        # Replace the alias (current_dir_replace_string) by the current dir before doing the test
-        alias = toBytes(current_dir_replace_string)
-        path = toBytes(self.tmp_dir)
-        findAndReplaceAllInDir(self.tmp_dir, alias, path)
-      try :
-        yield self.tmp_dir
-      except :
-        raise
+        block.tmp_dir.mkdir()
+    if block.alias :
+      # Replace the alias (current_dir_replace_string) by the current dir before doing the test
+      block.path = toBytes(block.tmp_dir)
+      with self._phase(block, 'replace') as stats :
+        block.replaced = findAndReplaceAllInDir(block.tmp_dir, block.alias, block.path, files=files, stats=stats, **block.replace_kwargs)
+        if not block.fused_replace :
+          # Only the files that got the path, and the ones modified inside the with block, need the reverse replacement
+          block.snapshot_ns = time.time_ns()
+          block.snapshot = _statTree(block.tmp_dir)
+
+  def _check(self, block:'_Block'):
+    """
+    Compare the candidate directory of `block` to the expected one, and raise an AssertionError with the report if they differ
+    """
+    replace = None
+    if block.alias :
+      if block.fused_replace :
+        # The current dir is replaced by the alias on the fly while comparing, leaving the candidate untouched
+        replace = StreamReplacement(block.path, block.alias, **block.replace_kwargs)
       else :
-        if current_dir_replace_string :
-          # Replace the current dir by the alias after doing the test, so that the comparison works well with the expected result
-          findAndReplaceAllInDir(self.tmp_dir, path, alias)
-        res, diffRes = cmpdir(self.tmp_dir, self.cwd / expected)
-        if res :
-          return
-        tio = StringIO()
-        formatDiff(tio, self.tmp_dir, self.cwd / expected, diffRes)
-        raise AssertionError(tio.getvalue())
+        # Replace the current dir by the alias after doing the test, so that the comparison works well with the expected result
+        with self._phase(block, 'replace_reverse') as stats :
+          files = _changedFiles(block.tmp_dir, block.snapshot, block.snapshot_ns, always=block.replaced)
+          findAndReplaceAllInDir(block.tmp_dir, block.path, block.alias, files=files, stats=stats, **block.replace_kwargs)
+    if self.update and not block.expected.exists() :
+      # A new test : with a .gitkeep in case the candidate stays empty
+      block.expected.mkdir(parents=True)
+      (block.expected / GITKEEP).touch()
+    with self._phase(block, 'compare') as stats :
+      res, diffRes = cmpdir(block.tmp_dir, block.expected_tree or block.expected, digests=self.digests, replace=replace, comparators=block.comparators, stats=stats, policy=block.policy, max_differences=block.max_differences, ignore=block.ignore, normalize=block.normalize)
+    if res :
+      self._releaseCandidate(block)
+      return
+    if self.update and not _isArchive(block.expected) :
+      with self._phase(block, 'update') as stats :
+        updateTree(block.tmp_dir, block.expected, diffRes, replace=replace, stats=stats, ignore=block.ignore)
+      if self.snapshots is not None :
+        self.snapshots.discard(block.expected)
+      self._releaseCandidate(block)
+      return
+    with self._phase(block, 'diff') as stats :
+      tio = StringIO()
+      formatDiff(tio, block.tmp_dir, block.expected_tree if isinstance(block.expected_tree, ArchiveTree) else block.expected, diffRes, replace=replace, comparators=block.comparators, normalize=block.normalize, **self.diff_options)
+      stats['files'] = len(diffRes[2])
+      stats['bytes'] = tio.tell()
+    raise AssertionError(tio.getvalue())
+
+  def _releaseCandidate(self, block:'_Block'):
+    """
+    Remove the candidate of a passing block when it is on tmpfs, so that it does not take memory until the end of the session.
+    The failing candidates are kept until the end of the session.
+    """
+    if block.root != self.tmp_path :
+      shutil.rmtree(block.tmp_dir, ignore_errors=True)
+
+  def _tearDown(self, block:'_Block'):
+    if block.phases :
+      # Like record_property, so that the phases end up in the JUnit XML report, and in the terminal summary
+      self.node.user_properties.append((f'{_PROPERTY_PREFIX}{block.tmp_dir.name}', json.dumps(block.phases)))
+    self.tmp_dir = None
+
+  @contextmanager
+  def __call__(self, *args, **kwargs):
+    block = self._prepare(*args, **kwargs)
+    try :
+      self._setUp(block)
+      self.tmp_dir = block.tmp_dir
+      yield block.tmp_dir
+      self._check(block)
     finally :
-      self.tmp_dir = None
+      self._tearDown(block)
+
+  @asynccontextmanager
+  async def async_(self, *args, executor:Executor|None=None, **kwargs):
+    """
+    Same as the with block, for `async with`, but the materialization, the replacements, the comparison and the report are run in `executor`
+    (the default executor of the event loop if None), so that they do not block the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    block = self._prepare(*args, **kwargs)
+    try :
+      await loop.run_in_executor(executor, self._setUp, block)
+      self.tmp_dir = block.tmp_dir
+      yield block.tmp_dir
+      await loop.run_in_executor(executor, self._check, block)
+    finally :
+      self._tearDown(block)
+
+class _Block(object):
+  """
+  State of one with block of ExpectDir
+  """
+  def __init__(self):
+    self.tmp_dir = None
+    self.phases = {}
+    self.materialized = {}
+    self.replaced = []
+    self.snapshot = None
+    self.snapshot_ns = None
+    self.path = None
+    self.initial_tree = None
+    self.expected_tree = None
+    self.snapshot_mode = False
+
+
+def pytest_addhooks(pluginmanager):
+  from . import hooks
+  pluginmanager.add_hookspecs(hooks)
+
+def pytest_addoption(parser):
+  group = parser.getgroup('expectdir')
+  group.addoption('--expectdir-update', action='store_true', default=False, help='Write the candidate directories back to the expected ones (the path replaced by current_dir_replace_string) instead of failing, rewriting only the files that differ.')
+  group.addoption('--expectdir-durations', type=int, default=None, metavar='N', help='Show the N slowest expectdir blocks, with the duration of each phase (N=0 for all).')
+  parser.addini('expectdir_comparators', 'Structured comparators of the files matching a glob, one "glob = comparator" per line, with comparator one of json, yaml, toml or xml.', type='linelist', default=[])
+  parser.addini('expectdir_compare_policy', 'How the content of the files of the same size is verified : stat (size and mtime only, like filecmp), size+hash (block digests, using the digest cache for the expected files), or full (byte by byte, the default, and the fastest with a warm page cache).', default='full')
+  parser.addini('expectdir_diff_algorithm', 'Line diff algorithm of the report : auto, difflib, or patience.', default='auto')
+  parser.addini('expectdir_diff_timeout', 'Seconds after which the patience diff of a file is replaced by a coarse summary (0 for no limit).', default='10')
+  parser.addini('expectdir_diff_intraline', 'Highlight the characters that changed in the replaced lines of the report.', type='bool', default=False)
+  parser.addini('expectdir_diff_max_files', 'Maximum number of files whose diff is shown in the report (0 for no limit).', default='100')
+  parser.addini('expectdir_diff_max_bytes', 'Maximum number of bytes read from each file to show its diff (0 for no limit).', default=str(1 << 20))
+  parser.addini('expectdir_diff_max_report', 'Maximum number of characters of the report (0 for no limit).', default=str(1000000))
+  parser.addini('expectdir_digest_cache', 'Keep the digests of the expected files in .pytest_cache, so that they are not read again at each session.', type='bool', default=True)
+  parser.addini('expectdir_digest_max_age', 'Number of days after which an unused entry of the expected files digest cache is evicted.', default='30')
+  parser.addini('expectdir_fused_replace', 'Replace the temporary directory path by current_dir_replace_string while comparing, instead of rewriting the candidate files.', type='bool', default=False)
+  parser.addini('expectdir_ignore', f'Gitignore-style patterns of the entries that are not compared, one per line (added to the ones of the {IGNORE_FILE} file of the rootdir).', type='linelist', default=[])
+  parser.addini('expectdir_max_differences', 'Stop comparing a directory once this number of differences is found (0 for no limit).', default='0')
+  parser.addini('expectdir_materialize', 'How initial directories are copied : auto (reflink if supported, else copy), copy, or hardlink.', default='auto')
+  parser.addini('expectdir_snapshot', 'Keep the initial and expected directories in memory, and put the candidates on tmpfs (/dev/shm) when available.', type='bool', default=False)
+  parser.addini('expectdir_snapshot_max_bytes', 'Maximum size of a directory kept in memory by the snapshot mode, the bigger ones are read from the disk (0 for no limit).', default=str(16 << 20))
+  parser.addini('expectdir_template_cache', 'Materialize each initial directory once per session, and clone the candidates from it.', type='bool', default=True)
+  parser.addini('expectdir_template_max_bytes', 'Disk budget of the initial directories materialized once per session, the least recently used ones are evicted (0 for no limit).', default=str(256 << 20))
+
+def pytest_configure(config):
+  count = config.getoption('expectdir_durations')
+  if count is not None :
+    config.pluginmanager.register(_DurationsReporter(count), 'expectdir-durations')
+  config._expectdir_digests = None
+  # The ignore rules of the session : the default ones, then the ini ones, then the ones of the ignore file of the rootdir
+  patterns = list(DEFAULT_IGNORE) + config.getini('expectdir_ignore')
+  ignore_file = Path(str(config.rootdir)) / IGNORE_FILE
+  if ignore_file.is_file() :
+    with open(ignore_file, 'r') as f :
+      patterns.extend(f.read().splitlines())
+  config._expectdir_ignore = IgnoreRules(patterns)
+  config._expectdir_normalizers = {}
+  config._expectdir_snapshots = _SnapshotCache(_iniLimit(config, 'expectdir_snapshot_max_bytes'))
+  config._expectdir_templates = _TemplateCache(_iniLimit(config, 'expectdir_template_max_bytes')) if config.getini('expectdir_template_cache') else None
+  cache = getattr(config, 'cache', None)
+  if cache is not None and config.getini('expectdir_digest_cache') :
+    config._expectdir_digests = DigestIndex(
+      Path(str(cache.makedir('expectdir'))) / 'digests.json',
+      max_age=float(config.getini('expectdir_digest_max_age')) * 24 * 3600,
+    )
+
+def pytest_unconfigure(config):
+  digests = getattr(config, '_expectdir_digests', None)
+  if digests is not None :
+    digests.save()
+  snapshots = getattr(config, '_expectdir_snapshots', None)
+  if snapshots is not None :
+    snapshots.close()
+  templates = getattr(config, '_expectdir_templates', None)
+  if templates is not None :
+    templates.close()
 
 
 @pytest.fixture
-def expectdir(tmp_path, request):
-  return ExpectDir(tmp_path, request)
+def expectdir(tmp_path, request, tmp_path_factory):
+  return ExpectDir(tmp_path, request, tmp_path_factory=tmp_path_factory)
 
 @pytest.fixture
-def expectdirReplace(tmp_path, request):
+def expectdirReplace(tmp_path, request, tmp_path_factory):
   """
   Equivalent to expectedir() except it provides a default value to current_dir_replace_string
   """
-  return ExpectDir(tmp_path, request, default_current_dir_replace_string='{{current_directory}}')
+  return ExpectDir(tmp_path, request, default_current_dir_replace_string='{{current_directory}}', tmp_path_factory=tmp_path_factory)
@@ -24,7 +24,7 @@ if sys.version_info < (3,):
 
 setup(
     name='pytest-expectdir',
-    version='1.2.0',
+    version='1.3.0',
     description='A pytest plugin to provide initial/expected directories, and check a test transforms the initial directory to the expected one',
     long_description=LONG_DESC,
     long_description_content_type='text/markdown',
@@ -37,7 +37,10 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=['pytest>=5.0'],
-    extras_require=None,
+    extras_require={
+      'yaml': ['pyyaml'],
+      'toml': ['tomli; python_version < "3.11"'],
+    },
     entry_points={
       "pytest11": ["pytest-expectdir = pytest_expectdir.plugin"],
     },
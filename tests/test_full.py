@@ -1,6 +1,9 @@
 from pathlib import Path
+import json
 import pytest
 
+pytest_plugins = 'pytester'
+
 class CustomError(RuntimeError):
   pass
 
@@ -297,3 +300,738 @@ def test_replacement_bytes(expectdir, expectdirReplace):
       content = f.read()
     assert content == f'{tmp_dir}\n'
 
+
+def test_cmpdir(tmp_path, monkeypatch):
+  from pytest_expectdir import plugin
+  from pytest_expectdir.plugin import cmpdir
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  for root in (candidate, expected) :
+    (root / 'sub').mkdir(parents=True)
+    (root / 'same').write_bytes(b'same content')
+    (root / 'sub' / 'same').write_bytes(b'x' * 200000)
+  (candidate / 'same_size').write_bytes(b'abcd')
+  (expected / 'same_size').write_bytes(b'abce')
+  (candidate / 'other_size').write_bytes(b'abcd')
+  (expected / 'other_size').write_bytes(b'abc')
+  (candidate / 'kind').mkdir()
+  (expected / 'kind').write_bytes(b'')
+  (expected / '.gitkeep').write_bytes(b'')
+  (candidate / 'sub' / 'late').write_bytes(b'1')
+  (expected / 'sub' / 'late').write_bytes(b'2')
+  # The small trees are compared in a single batch, without the thread pool, unless the batches are tiny
+  for min_bytes in (plugin.PARALLEL_MIN_BYTES, 1) :
+    monkeypatch.setattr(plugin, 'PARALLEL_MIN_BYTES', min_bytes)
+    for workers in (None, 1) :
+      res, (left, right, diff) = cmpdir(candidate, expected, workers=workers)
+      assert not res
+      assert left == [Path('kind')]
+      assert right == [Path('kind')]
+      assert diff == [Path('other_size'), Path('same_size'), Path('sub/late')]
+  assert cmpdir(candidate / 'sub', candidate / 'sub') == (True, ([], [], []))
+
+def test_digest_index(tmp_path, monkeypatch):
+  import os, time
+  from pytest_expectdir import plugin
+  index_path = tmp_path / 'digests.json'
+  f = tmp_path / 'f'
+  f.write_bytes(b'content')
+  old = time.time_ns() - 10 * 10**9
+  os.utime(f, ns=(old, old))
+  hashed = []
+  iterFile = plugin._iterFile
+  def countingIterFile(path, *args):
+    hashed.append(str(path))
+    return iterFile(path, *args)
+  monkeypatch.setattr(plugin, '_iterFile', countingIterFile)
+  
+  index = plugin.DigestIndex(index_path)
+  digest = index.digest(f)
+  assert index.digest(f) == digest
+  assert hashed == [str(f.absolute())]
+  index.save()
+  
+  index = plugin.DigestIndex(index_path)
+  assert index.digest(f) == digest
+  assert len(hashed) == 1
+  
+  f.write_bytes(b'other content')
+  other = index.digest(f)
+  assert other != digest
+  assert len(hashed) == 2
+  # Just modified : a same-size edit in the same timestamp tick would go unnoticed, so it is not trusted yet
+  mtime = f.stat().st_mtime_ns
+  f.write_bytes(b'OTHER content')
+  os.utime(f, ns=(mtime, mtime))
+  assert index.digest(f) != other
+  assert len(hashed) == 3
+  os.utime(f, ns=(old, old))
+  index.digest(f)
+  index.digest(f)
+  assert len(hashed) == 4
+  
+  index.entries[str(f.absolute())][3] -= 2 * index.max_age
+  index.dirty = True
+  index.save()
+  assert plugin.DigestIndex(index_path).entries == {}
+
+def test_cmpdir_digests(tmp_path):
+  from pytest_expectdir.plugin import cmpdir, DigestIndex
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  for root in (candidate, expected) :
+    root.mkdir()
+    (root / 'same').write_bytes(b'same')
+  (candidate / 'diff').write_bytes(b'abcd')
+  (expected / 'diff').write_bytes(b'abce')
+  index = DigestIndex()
+  assert cmpdir(candidate, expected, digests=index) == (False, ([], [], [Path('diff')]))
+  assert set(index.entries) == { str(expected / 'same'), str(expected / 'diff') }
+
+def test_materialize(expectdir, expectdirReplace, request):
+  from pytest_expectdir.plugin import materializeTree
+  initial = Path(request.module.__file__).parent / 'test_full/test_replacement/initial'
+  for strategy in ('auto', 'copy', 'hardlink') :
+    with expectdir('test_full/test_replacement', materialize=strategy) :
+      pass
+    assert sum(expectdir.materialized.values()) == 1
+    assert set(expectdir.materialized) <= { 'reflink', 'copy', 'hardlink' }
+    # The replacement must break the hardlinks instead of modifying initial/
+    with expectdirReplace('test_full/test_replacement', materialize=strategy) :
+      pass
+    assert (initial / 'test_file').read_text() == '{{current_directory}}\n'
+  assert expectdir.materialized == { 'hardlink' : 1 }
+  with pytest.raises(ValueError, match='Unknown materialization strategy') :
+    materializeTree(initial, expectdir.tmp_path / 'invalid', 'invalid')
+
+def test_find_and_replace(tmp_path):
+  from pytest_expectdir.plugin import findAndReplaceAllInDir
+  (tmp_path / 'sub').mkdir()
+  (tmp_path / 'no_match').write_bytes(b'nothing here')
+  (tmp_path / 'sub' / 'match.txt').write_bytes(b'a{{x}}b' * 10)
+  (tmp_path / 'binary').write_bytes(b'\0{{x}}')
+  (tmp_path / 'latin1').write_bytes(b'\xe9t\xe9 {{x}}')
+  (tmp_path / 'excluded.log').write_bytes(b'{{x}}')
+  mtime = (tmp_path / 'no_match').stat().st_mtime_ns
+  # A single pattern may be passed as a str
+  replaced = findAndReplaceAllInDir(tmp_path, b'{{x}}', b'/some/path', exclude='*.log', binary=False, chunk_size=3)
+  assert replaced == [Path('sub/match.txt')]
+  assert (tmp_path / 'sub' / 'match.txt').read_bytes() == b'a/some/pathb' * 10
+  assert (tmp_path / 'binary').read_bytes() == b'\0{{x}}'
+  assert (tmp_path / 'latin1').read_bytes() == b'\xe9t\xe9 {{x}}'
+  assert (tmp_path / 'excluded.log').read_bytes() == b'{{x}}'
+  assert (tmp_path / 'no_match').stat().st_mtime_ns == mtime
+  
+  replaced = findAndReplaceAllInDir(tmp_path, b'/some/path', b'{{x}}', include=['match.txt'], chunk_size=4)
+  assert replaced == [Path('sub/match.txt')]
+  assert (tmp_path / 'sub' / 'match.txt').read_bytes() == b'a{{x}}b' * 10
+  
+  assert findAndReplaceAllInDir(tmp_path, b'{{x}}', b'!', files=[Path('binary')]) == [Path('binary')]
+  assert (tmp_path / 'binary').read_bytes() == b'\0!'
+
+def test_replacement_new_files(expectdirReplace):
+  with expectdirReplace('test_full/test_replacement') as tmp_dir :
+    (tmp_dir / 'test_file').unlink()
+    (tmp_dir / 'test_file').write_text(f'{tmp_dir}\n')
+  with pytest.raises(AssertionError, match='test_file') :
+    with expectdirReplace('test_full/test_replacement') as tmp_dir :
+      (tmp_dir / 'test_file').unlink()
+
+def test_fused_replace(expectdirReplace):
+  with expectdirReplace('test_full/test_replacement', fused_replace=True) as tmp_dir :
+    pass
+  # The candidate is left untouched
+  assert (tmp_dir / 'test_file').read_text() == f'{tmp_dir}\n'
+  
+  with pytest.raises(AssertionError) as excinfo :
+    with expectdirReplace('test_full/test_replacement', fused_replace=True) as tmp_dir :
+      (tmp_dir / 'test_file').write_text(f'{tmp_dir}\nextra\n')
+  assert '\x1b[39m    {{current_directory}}\n\x1b[32m  + extra\n' in str(excinfo.value)
+  
+  with expectdirReplace('test_full/test_replacement', fused_replace=True, replace_exclude=['test_file']) as tmp_dir :
+    (tmp_dir / 'test_file').write_text('{{current_directory}}\n')
+
+def test_format_diff_limits(request):
+  from io import StringIO
+  from pytest_expectdir.plugin import cmpdir, formatDiff
+  initial = Path(request.module.__file__).parent / 'data/test3/initial'
+  expected = Path(request.module.__file__).parent / 'data/test3/expected'
+  diffRes = cmpdir(initial, expected)[1]
+  full = StringIO()
+  formatDiff(full, initial, expected, diffRes)
+  
+  tio = StringIO()
+  formatDiff(tio, initial, expected, diffRes, max_files=1)
+  report = tio.getvalue()
+  assert report.startswith(full.getvalue().split('\n\n\x1b[33mdir4/f3:')[0])
+  assert report.endswith('\n\x1b[36m1 other files with different content are not shown :\n\x1b[33mdir4/f3\n')
+  
+  tio = StringIO()
+  formatDiff(tio, initial, expected, diffRes, max_report=100)
+  assert tio.getvalue() == full.getvalue()[:100] + '\n\x1b[36m[...] Report truncated to 100 characters, 2 files with different content are not shown.\n'
+  
+  tio = StringIO()
+  formatDiff(tio, initial, expected, diffRes, max_bytes=10)
+  assert '\n\x1b[33mf3:\n\x1b[36m  (only the first 10 bytes are compared)\n' in tio.getvalue()
+
+def test_diff_algorithms():
+  from io import StringIO
+  from pytest_expectdir.plugin import formatFileDiff, diffOpcodes
+  expected = [ f'line {i}\n' for i in range(20) ]
+  candidate = expected[:5] + ['inserted\n'] + expected[5:12] + expected[13:]
+  
+  reference = StringIO()
+  formatFileDiff(reference, candidate, expected)
+  for algorithm in ('auto', 'patience') :
+    tio = StringIO()
+    formatFileDiff(tio, candidate, expected, algorithm=algorithm, timeout=10)
+    assert tio.getvalue() == reference.getvalue()
+  
+  tio = StringIO()
+  formatFileDiff(tio, candidate, expected, algorithm='patience', timeout=-1)
+  assert tio.getvalue() == (
+    ''.join('\x1b[39m\x1b[39m    line 0\n' if i == 0 else f'\x1b[39m    line {i}\n' for i in range(5))
+    + '\x1b[36m  [...] --- diff too long to compute : \x1b[31mexpected:6-13\x1b[36m / \x1b[32mcandidate:6-13\x1b[36m differ ---\n\x1b[39m'
+    + ''.join(f'\x1b[39m    line {i}\n' for i in range(13, 20))
+  )
+  with pytest.raises(ValueError, match='Unknown diff algorithm') :
+    diffOpcodes(expected, candidate, 'invalid')
+
+def test_intraline_diff():
+  from io import StringIO
+  from pytest_expectdir.plugin import formatFileDiff
+  expected = ['{"date": "2020-01-01", "id": 1}\n', 'totally different\n', 'x' * 20 + '\n']
+  candidate = ['{"date": "2021-01-01", "id": 1}\n', 'nothing in common\n', 'x' * 19 + 'y\n']
+  
+  tio = StringIO()
+  formatFileDiff(tio, candidate, expected, intraline=True)
+  assert tio.getvalue() == (
+    '\x1b[31m  - {"date": "202\x1b[7m0\x1b[27m-01-01", "id": 1}\n'
+    '\x1b[31m  - totally different\n'
+    f'\x1b[31m  - {"x" * 19}\x1b[7mx\x1b[27m\n'
+    '\x1b[32m  + {"date": "202\x1b[7m1\x1b[27m-01-01", "id": 1}\n'
+    '\x1b[32m  + nothing in common\n'
+    f'\x1b[32m  + {"x" * 19}\x1b[7my\x1b[27m\n'
+  )
+  
+  tio = StringIO()
+  formatFileDiff(tio, candidate, expected, intraline=True, intraline_max_length=25, intraline_max_pairs=2)
+  reference = StringIO()
+  formatFileDiff(reference, candidate, expected)
+  assert tio.getvalue() == reference.getvalue()
+
+def test_comparators(expectdir):
+  comparators = { '*.json' : 'json', '*.xml' : 'xml', '*.yaml' : 'yaml' }
+  with expectdir(comparators=comparators) as tmp_dir :
+    (tmp_dir / 'data.json').write_text('{"a": {"x": "y"}, "b": [1, 2, 3]}')
+    (tmp_dir / 'doc.xml').write_text('<root id="1"><child> text </child></root>')
+    (tmp_dir / 'conf.yaml').write_text('{"b": ["x"], "a": 1}')
+  
+  with pytest.raises(AssertionError) as excinfo :
+    with expectdir(comparators=comparators) as tmp_dir :
+      (tmp_dir / 'data.json').write_text('{"a": {"x": "z", "w": 0}, "b": [1, 2]}')
+      (tmp_dir / 'doc.xml').write_text('<root id="2"><child>text</child></root>')
+      (tmp_dir / 'conf.yaml').write_text('a: [')
+  report = str(excinfo.value)
+  assert (
+    '\x1b[33mdata.json:\n'
+    '\x1b[31m  - $.b[2]: 3\n'
+    '\x1b[31m  - $.a.x: "y"\n'
+    '\x1b[32m  + $.a.x: "z"\n'
+    '\x1b[32m  + $.a.w: 0\n'
+  ) in report
+  assert '\x1b[33mdoc.xml:\n\x1b[31m  - $.attrib.id: "1"\n\x1b[32m  + $.attrib.id: "2"\n' in report
+  assert '\x1b[33mconf.yaml:\n\x1b[32m  candidate cannot be parsed : ' in report
+  
+  # true == 1 in Python, but not in JSON
+  with pytest.raises(AssertionError) as excinfo :
+    with expectdir(comparators=comparators) as tmp_dir :
+      (tmp_dir / 'data.json').write_text('{"a": {"x": "y"}, "b": [true, 2, 3.0]}')
+      (tmp_dir / 'doc.xml').write_text('<root id="1"><child>text</child></root>')
+      (tmp_dir / 'conf.yaml').write_text('a: 1\nb:\n  - x\n')
+  report = str(excinfo.value)
+  assert '\x1b[31m  - $.b[0]: 1\n\x1b[32m  + $.b[0]: true\n' in report
+  assert '\x1b[31m  - $.b[2]: 3\n\x1b[32m  + $.b[2]: 3.0\n' in report
+  assert 'doc.xml' not in report
+  
+  with pytest.raises(AssertionError, match='data.json') :
+    with expectdir() as tmp_dir :
+      (tmp_dir / 'data.json').write_text('{"a": {"x": "y"}, "b": [1, 2, 3]}')
+      (tmp_dir / 'doc.xml').write_text('<root id="1"><child>text</child></root>')
+      (tmp_dir / 'conf.yaml').write_text('a: 1\nb:\n  - x\n')
+  
+  with pytest.raises(ValueError, match='Unknown comparator') :
+    with expectdir(comparators={ '*.json' : 'invalid' }) :
+      pass
+
+def test_phases(expectdirReplace, request, monkeypatch, tmp_path):
+  import os, shutil, time
+  # Whether the templates were built by the previous tests would change the counts
+  monkeypatch.setattr(expectdirReplace, 'templates', None)
+  # And so would the files of a fresh checkout, that are too recent for their mtime to be trusted by the reverse replacement
+  data = tmp_path / 'data'
+  shutil.copytree(Path(request.module.__file__).parent / 'data', data)
+  old = time.time_ns() - 10 * 10**9
+  for p in data.rglob('*') :
+    os.utime(p, ns=(old, old))
+  calls = []
+  class Recorder(object):
+    def pytest_expectdir_phase(self, item, candidate, phase, duration, bytes, files):
+      calls.append((item, candidate.name, phase, files))
+  request.config.pluginmanager.register(Recorder(), 'recorder')
+  try :
+    with expectdirReplace(data / 'test1') :
+      pass
+    with pytest.raises(AssertionError) :
+      with expectdirReplace(data / 'test3') :
+        pass
+  finally :
+    request.config.pluginmanager.unregister(name='recorder')
+  assert calls == [
+    (request.node, 'candidate0', 'materialize', 2),
+    (request.node, 'candidate0', 'replace', 2),
+    (request.node, 'candidate0', 'replace_reverse', 0),
+    (request.node, 'candidate0', 'compare', 2),
+    (request.node, 'candidate1', 'materialize', 7),
+    (request.node, 'candidate1', 'replace', 7),
+    (request.node, 'candidate1', 'replace_reverse', 0),
+    (request.node, 'candidate1', 'compare', 5),
+    (request.node, 'candidate1', 'diff', 2),
+  ]
+  properties = dict(request.node.user_properties)
+  assert set(properties) == { 'expectdir:candidate0', 'expectdir:candidate1' }
+  assert json.loads(properties['expectdir:candidate0'])['materialize']['bytes'] == 14
+
+def test_durations_summary(pytester):
+  pytester.makepyfile(test_durations="""
+    def test_a(expectdir):
+      with expectdir(expected='expected') :
+        pass
+  """)
+  pytester.mkdir('expected')
+  result = pytester.runpytest('--expectdir-durations=0')
+  result.assert_outcomes(passed=1)
+  result.stdout.fnmatch_lines([
+    '*= slowest expectdir blocks =*',
+    '*s test_durations.py::test_a [[]candidate0[]] : materialize *s (0 files, 0 B), compare *s (0 files, 0 B)',
+  ])
+
+def test_compare_policies(tmp_path):
+  import os
+  from pytest_expectdir.plugin import cmpdir, DigestIndex
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  candidate.mkdir()
+  expected.mkdir()
+  # Same size and mtime, but different content
+  (candidate / 'f').write_bytes(b'abcd')
+  (expected / 'f').write_bytes(b'abce')
+  st = os.stat(expected / 'f')
+  os.utime(candidate / 'f', ns=(st.st_atime_ns, st.st_mtime_ns))
+  # Differ only in the last block
+  block = DigestIndex.BLOCK_SIZE
+  (candidate / 'big').write_bytes(b'x' * block + b'y')
+  (expected / 'big').write_bytes(b'x' * block + b'z')
+  (candidate / 'same').write_bytes(b'x' * block * 2)
+  (expected / 'same').write_bytes(b'x' * block * 2)
+  
+  assert cmpdir(candidate, expected, policy='stat') == (False, ([], [], [Path('big')]))
+  assert cmpdir(candidate, expected, policy='full') == (False, ([], [], [Path('big'), Path('f')]))
+  index = DigestIndex()
+  assert cmpdir(candidate, expected, policy='size+hash', digests=index) == (False, ([], [], [Path('big'), Path('f')]))
+  assert len(index.entries[str(expected / 'big')][2]) == 2
+  assert index.matches(expected / 'same', [b'x' * (block * 2)])
+  assert not index.matches(expected / 'same', [b'x' * (block * 2 + 1)])
+  assert not index.matches(expected / 'same', [b'x' * block])
+  with pytest.raises(ValueError, match='Unknown compare policy') :
+    cmpdir(candidate, expected, policy='invalid')
+
+def test_max_differences(tmp_path):
+  from io import StringIO
+  from pytest_expectdir.plugin import cmpdir, formatDiff
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  candidate.mkdir()
+  expected.mkdir()
+  for i in range(5) :
+    (candidate / f'f{i}').write_text(f'candidate {i}\n')
+    (expected / f'f{i}').write_text(f'expected {i}\n')
+  (candidate / 'new').write_text('new\n')
+  
+  res, diffRes = cmpdir(candidate, expected)
+  assert not res and len(diffRes[2]) == 5 and not diffRes.truncated
+  res, diffRes = cmpdir(candidate, expected, max_differences=3)
+  assert not res and diffRes.truncated
+  assert diffRes == ([Path('new')], [], [Path('f0'), Path('f1')])
+  res, diffRes = cmpdir(candidate, expected, max_differences=1, workers=1)
+  assert diffRes == ([Path('new')], [], []) and diffRes.truncated
+  res, diffRes = cmpdir(candidate, expected, max_differences=10)
+  assert len(diffRes[2]) == 5 and not diffRes.truncated
+  
+  out = StringIO()
+  formatDiff(out, candidate, expected, cmpdir(candidate, expected, max_differences=2)[1])
+  assert 'The comparison stopped after 2 differences, there may be more.' in out.getvalue()
+
+def test_fail_fast(expectdir):
+  with pytest.raises(AssertionError, match='stopped after 1 differences') :
+    with expectdir(fail_fast=True) as d :
+      (d / 'a').write_text('wrong\n')
+      (d / 'b').write_text('wrong\n')
+
+def test_digest_index_merge(tmp_path):
+  from pytest_expectdir.plugin import DigestIndex
+  index_path = tmp_path / 'digests.json'
+  files = []
+  for name in 'abc' :
+    files.append(tmp_path / name)
+    files[-1].write_bytes(name.encode())
+  # Two workers loading the same index, and saving their own entries
+  first = DigestIndex(index_path)
+  second = DigestIndex(index_path)
+  first.digest(files[0])
+  second.digest(files[1])
+  first.save()
+  second.save()
+  entries = DigestIndex(index_path).entries
+  assert sorted(entries) == sorted(str(f.absolute()) for f in files[:2])
+  # The entries updated by a worker win over the ones of the file
+  files[0].write_bytes(b'changed')
+  second.digest(files[0])
+  second.save()
+  assert DigestIndex(index_path).entries[str(files[0].absolute())][0] == len(b'changed')
+
+def test_threaded_candidates(tmp_path, request):
+  from concurrent.futures import ThreadPoolExecutor
+  from pytest_expectdir.plugin import ExpectDir
+  expected = Path(__file__).parent / 'test_full' / 'test_threaded_candidates' / 'expected'
+  def run(i):
+    with ExpectDir(tmp_path, request)(expected=expected) as d :
+      (d / 'f').write_text('content\n')
+    return d
+  with ThreadPoolExecutor(8) as executor :
+    candidates = list(executor.map(run, range(32)))
+  assert len(set(candidates)) == 32
+
+def test_async(expectdirReplace):
+  import asyncio
+  ticks = []
+  async def ticker():
+    for i in range(3) :
+      ticks.append(i)
+      await asyncio.sleep(0)
+  async def main():
+    async with expectdirReplace.async_('data/test1') as d :
+      assert d == expectdirReplace.tmp_dir
+      assert d.is_dir()
+    with pytest.raises(AssertionError) as sync_error :
+      with expectdirReplace('data/test3') as sync_dir :
+        pass
+    with pytest.raises(AssertionError) as async_error :
+      async with expectdirReplace.async_('data/test3') as async_dir :
+        pass
+    assert async_dir != sync_dir
+    assert str(async_error.value).replace(str(async_dir), '') == str(sync_error.value).replace(str(sync_dir), '')
+    # The event loop runs the other tasks while the block is set up and checked
+    async def block():
+      async with expectdirReplace.async_('data/test1') :
+        pass
+    await asyncio.gather(block(), ticker())
+    assert ticks == [0, 1, 2]
+  asyncio.run(main())
+
+def test_snapshot(expectdirReplace, request, tmp_path):
+  from pytest_expectdir.plugin import TreeSnapshot, cmpdir
+  data = Path(request.module.__file__).parent / 'data'
+  with expectdirReplace('data/test1', snapshot=True) as d :
+    on_shm = tmp_path not in d.parents
+    if Path('/dev/shm').is_dir() :
+      assert on_shm
+  # The passing candidates are removed from tmpfs
+  assert d.exists() != on_shm
+  assert expectdirReplace.materialized == { 'snapshot' : 2 }
+  with pytest.raises(AssertionError) as disk_error :
+    with expectdirReplace('data/test3') as disk_dir :
+      pass
+  with pytest.raises(AssertionError) as snapshot_error :
+    with expectdirReplace('data/test3', snapshot=True) as snapshot_dir :
+      pass
+  assert str(snapshot_error.value).replace(str(snapshot_dir), '') == str(disk_error.value).replace(str(disk_dir), '')
+  assert snapshot_dir.exists()
+  # The snapshot is loaded once per session
+  snapshots = request.config._expectdir_snapshots
+  assert snapshots.get(data / 'test3' / 'expected') is snapshots.get(data / 'test3' / 'expected')
+  
+  snapshot = TreeSnapshot(data / 'test3' / 'expected')
+  assert cmpdir(data / 'test3' / 'initial', snapshot) == cmpdir(data / 'test3' / 'initial', data / 'test3' / 'expected')
+  snapshot.materialize(tmp_path / 'copy')
+  assert cmpdir(tmp_path / 'copy', data / 'test3' / 'expected')[0]
+  with pytest.raises(ValueError) :
+    TreeSnapshot(data / 'test3' / 'expected', max_bytes=10)
+
+def test_archives(expectdir, request, tmp_path):
+  import tarfile, zipfile, zlib
+  from io import StringIO
+  from pytest_expectdir.plugin import ArchiveTree, cmpdir, formatDiff
+  data = Path(request.module.__file__).parent / 'data'
+  expected = data / 'test3' / 'expected'
+  candidate = data / 'test3' / 'initial'
+  with tarfile.open(tmp_path / 'expected.tar', 'w') as tar :
+    tar.add(expected, arcname='.')
+  for name, compression in (('stored.zip', zipfile.ZIP_STORED), ('deflated.zip', zipfile.ZIP_DEFLATED)) :
+    with zipfile.ZipFile(tmp_path / name, 'w', compression) as z :
+      for p in sorted(expected.rglob('*')) :
+        z.write(p, p.relative_to(expected).as_posix())
+  
+  reference = cmpdir(candidate, expected)
+  report = StringIO()
+  formatDiff(report, candidate, expected, reference[1])
+  for name in ('expected.tar', 'stored.zip', 'deflated.zip') :
+    tree = ArchiveTree(tmp_path / name)
+    for policy in ('full', 'size+hash') :
+      assert cmpdir(candidate, tree, policy=policy) == reference
+    tree_report = StringIO()
+    formatDiff(tree_report, candidate, tree, reference[1])
+    assert tree_report.getvalue().replace(str(tmp_path / name), str(expected)) == report.getvalue()
+    tree.materialize(tmp_path / f'{name}.out')
+    assert cmpdir(tmp_path / f'{name}.out', expected)[0]
+    tree.close()
+  
+  # A CRC32 collision is not taken for an equal file
+  with zipfile.ZipFile(tmp_path / 'crc.zip', 'w', zipfile.ZIP_DEFLATED) as z :
+    z.writestr('f', b'expected content')
+  tree = ArchiveTree(tmp_path / 'crc.zip')
+  assert tree.matches(Path('f'), [b'expected', b' content'], 'size+hash')
+  assert not tree.matches(Path('f'), [b'expected', b' CONTENT'], 'size+hash')
+  offset, size, mode, crc, compressed = tree.files[Path('f')]
+  tree.files[Path('f')] = (offset, size, mode, zlib.crc32(b'candidate colliding'), compressed)
+  assert not tree.matches(Path('f'), [b'candidate colliding'], 'size+hash')
+  tree.close()
+  
+  # expected= and initial= may be archives, and datapath/expected may be packed
+  with expectdir(initial=tmp_path / 'stored.zip', expected=tmp_path / 'expected.tar') :
+    pass
+  datapath = tmp_path / 'data'
+  datapath.mkdir()
+  (tmp_path / 'deflated.zip').rename(datapath / 'expected.zip')
+  with expectdir(datapath, initial=tmp_path / 'expected.tar') as d :
+    assert (d / 'dir4' / 'f3').is_file()
+  with pytest.raises(AssertionError, match='Missing in candidate') :
+    with expectdir(datapath, initial='__empty__') :
+      pass
+
+def test_update(pytester):
+  import os
+  pytester.makepyfile(test_update="""
+    def test_a(expectdirReplace):
+      with expectdirReplace(expected='expected') as d :
+        (d / 'same').write_text('same\\n')
+        (d / 'changed').write_text(f'new {d}\\n')
+        (d / 'emptied').mkdir()
+        (d / 'empty').mkdir()
+        (d / 'added').mkdir()
+        (d / 'added' / 'f').write_text('added\\n')
+    
+    def test_new(expectdir):
+      with expectdir(expected='new/expected') as d :
+        (d / 'f').write_text('new\\n')
+    
+    def test_new_empty(expectdir):
+      with expectdir(expected='new/empty') as d :
+        pass
+    
+    def test_new_error(expectdir):
+      with expectdir(expected='new/error') as d :
+        raise RuntimeError()
+  """)
+  expected = pytester.mkdir('expected')
+  (expected / 'same').write_text('same\n')
+  (expected / 'changed').write_text('old\n')
+  (expected / 'removed').write_text('removed\n')
+  (expected / 'emptied').mkdir()
+  (expected / 'emptied' / 'f').write_text('removed\n')
+  (expected / 'empty').mkdir()
+  (expected / 'empty' / '.gitkeep').write_text('')
+  os.utime(expected / 'same', ns=(0, 0))
+  
+  result = pytester.runpytest()
+  result.assert_outcomes(failed=4)
+  result = pytester.runpytest('--expectdir-update')
+  result.assert_outcomes(passed=3, failed=1)
+  # Not created when the with block failed
+  assert not (pytester.path / 'new' / 'error').exists()
+  assert (expected / 'same').stat().st_mtime_ns == 0
+  assert (expected / 'changed').read_text() == 'new {{current_directory}}\n'
+  assert not (expected / 'removed').exists()
+  assert sorted(p.name for p in (expected / 'emptied').iterdir()) == ['.gitkeep']
+  assert (expected / 'empty' / '.gitkeep').exists()
+  assert (expected / 'added' / 'f').read_text() == 'added\n'
+  assert (pytester.path / 'new' / 'expected' / 'f').read_text() == 'new\n'
+  # git does not track the empty directories
+  assert [p.name for p in (pytester.path / 'new' / 'empty').iterdir()] == ['.gitkeep']
+  result = pytester.runpytest()
+  result.assert_outcomes(passed=3, failed=1)
+
+def test_template_cache(tmp_path, tmp_path_factory):
+  from pytest_expectdir.plugin import _TemplateCache
+  kwargs = dict(include=None, exclude=None, binary=True)
+  initials = []
+  for i in range(3) :
+    initial = tmp_path / f'initial{i}'
+    (initial / 'dir').mkdir(parents=True)
+    (initial / 'dir' / 'alias').write_bytes(b'path: {{current_directory}}\n' + b'x' * 100)
+    (initial / 'other').write_bytes(b'y' * 100)
+    initials.append(initial)
+  cache = _TemplateCache(500)
+  # No template for the first use, that would be a copy more
+  assert cache.clone(initials[0], tmp_path / 'c', 'copy', b'{{current_directory}}', kwargs, tmp_path_factory) is None
+  assert cache.count == 0 and not (tmp_path / 'c').exists()
+  methods, index = cache.clone(initials[0], tmp_path / 'c0', 'copy', b'{{current_directory}}', kwargs, tmp_path_factory)
+  assert methods == { 'copy' : 2 } and index == [Path('dir/alias')]
+  assert (tmp_path / 'c0' / 'other').read_bytes() == b'y' * 100
+  cache.clone(initials[0], tmp_path / 'c1', 'copy', b'{{current_directory}}', kwargs, tmp_path_factory)
+  assert cache.count == 1
+  # Another alias is another template
+  for name in ('c2', 'c2bis') :
+    res = cache.clone(initials[0], tmp_path / name, 'copy', None, kwargs, tmp_path_factory)
+  assert res[1] == []
+  assert cache.count == 2
+  # The least recently used template is evicted once the budget is exceeded
+  for i in (1, 2) :
+    for name in ('c3', 'c4') :
+      cache.clone(initials[i], tmp_path / f'{name}{i}', 'copy', None, kwargs, tmp_path_factory)
+  assert len(cache.templates) == 2 and cache.size <= 500
+  # The trees bigger than the budget are not cached
+  small = _TemplateCache(100)
+  small.clone(initials[0], tmp_path / 'c5', 'copy', None, kwargs, tmp_path_factory)
+  assert small.clone(initials[0], tmp_path / 'c6', 'copy', None, kwargs, tmp_path_factory) is None
+  assert small.templates == { next(iter(small.seen)) : None }
+  cache.close()
+
+def test_binary_diff(tmp_path):
+  from io import StringIO
+  from pytest_expectdir.plugin import cmpdir, formatDiff, isBinaryFile, _isBinaryData
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  candidate.mkdir()
+  expected.mkdir()
+  (candidate / 'image.bin').write_bytes(b'\x89PNG\r\n\x1a\n' + bytes(range(256)) + b'tail')
+  (expected / 'image.bin').write_bytes(b'\x89PNG\r\n\x1a\n' + bytes(range(255)) + b'\x00')
+  (candidate / 'latin1.txt').write_bytes('caf\xe9\n'.encode('latin-1'))
+  (expected / 'latin1.txt').write_bytes('cafe\n'.encode('latin-1'))
+  assert isBinaryFile(candidate / 'image.bin') and isBinaryFile(candidate / 'latin1.txt')
+  assert not isBinaryFile(expected / 'latin1.txt')
+  # A multibyte character cut by the end of the head is not binary
+  assert not _isBinaryData('é'.encode()[:1]) and _isBinaryData(b'\xe9a')
+  
+  out = StringIO()
+  formatDiff(out, candidate, expected, cmpdir(candidate, expected)[1])
+  report = out.getvalue()
+  assert '\x1b[33mimage.bin:\n\x1b[36m  binary files : \x1b[31mexpected 264 bytes\x1b[36m / \x1b[32mcandidate 268 bytes\x1b[36m (+4)\n\x1b[36m  first difference at offset 263 (0x107)\n' in report
+  assert '\x1b[31m  - 00000100  f8 f9 fa fb fc fd fe 00 ' in report
+  assert '\x1b[32m  + 00000100  f8 f9 fa fb fc fd fe ff 74 61 69 6c ' in report
+  assert '\x1b[33mlatin1.txt:\n\x1b[36m  binary files : \x1b[31mexpected 5 bytes\x1b[36m / \x1b[32mcandidate 5 bytes\x1b[36m (+0)\n\x1b[36m  first difference at offset 3 (0x3)\n' in report
+
+def test_ignore_rules(tmp_path, monkeypatch):
+  import os
+  from pytest_expectdir import plugin
+  rules = plugin.IgnoreRules(['.gitkeep', '# comment', '__pycache__/', '*.lock', '!keep.lock', '/build', 'logs/**/*.log', 'tmp?/', r'\#hash', 'v[0-9].txt'])
+  cases = {
+    ('.gitkeep', False) : True,
+    ('a/b/.gitkeep', False) : True,
+    ('a/__pycache__', True) : True,
+    ('__pycache__', False) : False,
+    ('poetry.lock', False) : True,
+    ('a/keep.lock', False) : False,
+    ('build', True) : True,
+    ('a/build', True) : False,
+    ('logs/x.log', False) : True,
+    ('logs/a/b/x.log', False) : True,
+    ('other/logs/x.log', False) : False,
+    ('tmp1', True) : True,
+    ('tmp12', True) : False,
+    ('#hash', False) : True,
+    ('v1.txt', False) : True,
+    ('va.txt', False) : False,
+  }
+  for (path, is_dir), ignored in cases.items() :
+    assert rules.ignored(Path(path), is_dir) == ignored, path
+  
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  for root in (candidate, expected) :
+    (root / 'src').mkdir(parents=True)
+    (root / 'src' / 'f').write_text('same\n')
+  for root in (candidate, expected) :
+    (root / 'src' / '__pycache__').mkdir()
+    (root / 'src' / '__pycache__' / 'f.pyc').write_bytes(root.name.encode())
+  (candidate / 'poetry.lock').write_text('candidate\n')
+  (expected / 'poetry.lock').write_text('expected\n')
+  scanned = []
+  scandir = os.scandir
+  def recordingScandir(path):
+    scanned.append(Path(path))
+    return scandir(path)
+  monkeypatch.setattr(plugin.os, 'scandir', recordingScandir)
+  assert not plugin.cmpdir(candidate, expected)[0]
+  assert candidate / 'src' / '__pycache__' in scanned
+  scanned.clear()
+  # The ignored directories are not walked
+  assert plugin.cmpdir(candidate, expected, ignore=rules) == (True, ([], [], []))
+  assert candidate / 'src' / '__pycache__' not in scanned
+
+def test_ignore_options(pytester):
+  pytester.makepyfile(test_ignore="""
+    def test_a(expectdir):
+      with expectdir(expected='expected', ignore=['*.tmp']) as d :
+        (d / 'f').write_text('f\\n')
+        (d / 'cache').mkdir()
+        (d / 'cache' / 'x').write_text('x\\n')
+        (d / 'out.log').write_text('log\\n')
+        (d / 'out.tmp').write_text('tmp\\n')
+  """)
+  pytester.makeini("""
+    [pytest]
+    expectdir_ignore =
+      cache/
+  """)
+  (pytester.path / '.expectdirignore').write_text('# volatile\n*.log\n')
+  expected = pytester.mkdir('expected')
+  (expected / 'f').write_text('f\n')
+  pytester.runpytest().assert_outcomes(passed=1)
+
+def test_normalize(expectdir, tmp_path):
+  import re
+  from io import StringIO
+  from pytest_expectdir.plugin import LineNormalizer, cmpdir, formatDiff
+  normalizer = LineNormalizer(['eol', 'trailing-whitespace', r'\d{4}-\d\d-\d\d', (re.compile(rb'id=\w+'), 'id=X')])
+  assert b''.join(normalizer.iterFile([b'a \r', b'\nb\t\r\n2024-', b'01-02 id=abc', b'\nlast  '])) == b'a\nb\n<masked> id=X\nlast'
+  
+  candidate = tmp_path / 'candidate'
+  expected = tmp_path / 'expected'
+  candidate.mkdir()
+  expected.mkdir()
+  (candidate / 'log').write_bytes(b'started 2024-01-02 \r\nid=1234\r\nend\r\n')
+  (expected / 'log').write_bytes(b'started 1999-12-31\nid=abcd\nend\n')
+  (candidate / 'other').write_bytes(b'2024-01-02 a\r\n')
+  (expected / 'other').write_bytes(b'1999-12-31 b\n')
+  assert cmpdir(candidate, expected) == (False, ([], [], [Path('log'), Path('other')]))
+  assert cmpdir(candidate, expected, normalize=normalizer) == (False, ([], [], [Path('other')]))
+  assert len(normalizer.cache) == 2
+  # A compiled str pattern applies to the bytes lines too
+  assert cmpdir(candidate, expected, normalize=LineNormalizer(['eol', 'trailing-whitespace', re.compile(r'\d{4}-\d\d-\d\d( \w)?'), re.compile(r'ID=\w+', re.I)])) == (True, ([], [], []))
+  out = StringIO()
+  formatDiff(out, candidate, expected, cmpdir(candidate, expected, normalize=normalizer)[1], normalize=normalizer)
+  assert out.getvalue().endswith('\x1b[33mother:\n\x1b[31m  - <masked> b\n\x1b[32m  + <masked> a\n')
+  
+  with expectdir(expected=expected, normalize=['eol', 'trailing-whitespace', r'\d{4}-\d\d-\d\d', (rb'id=\w+', 'id=X')]) as d :
+    (d / 'log').write_bytes(b'started 2000-01-01\r\nid=0\nend   \n')
+    (d / 'other').write_bytes(b'2000-01-01 b\r\n')
+  # A single rule may be passed as a str, not split into one-letter masks
+  expected_eol = tmp_path / 'expected_eol'
+  expected_eol.mkdir()
+  (expected_eol / 'f').write_bytes(b'hello\n')
+  with expectdir(expected=expected_eol, normalize='eol') as d :
+    (d / 'f').write_bytes(b'hello\r\n')
+  with pytest.raises(AssertionError) :
+    with expectdir(expected=expected_eol, normalize='eol') as d :
+      (d / 'f').write_bytes(b'hoeeo\n')